@@ -1,33 +1,78 @@
 #!/usr/bin/python3
+import argparse
 import asyncio
 import base64
+import bisect
+import gzip
+import hashlib
+import heapq
+import itertools
 import json
+import multiprocessing
+import multiprocessing.connection
 import os
+import random
+import re
+import signal
+import socket
+import sqlite3
+import struct
+import tempfile
+import threading
 import time
-from collections import defaultdict
-from enum import Enum
+import zlib
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import Enum, IntEnum
+from functools import partial
 from types import TracebackType
 from typing import (Annotated, Any, AsyncContextManager, AsyncGenerator,
-                    Awaitable, ClassVar, Generator, Literal)
+                    Awaitable, Callable, ClassVar, Generator, Generic,
+                    Hashable, Iterable, Literal, Mapping, TypeVar)
 from urllib.parse import quote as encodeuri
 from urllib.parse import unquote as decodeuri
+from urllib.parse import quote_plus, unquote_plus, unquote_to_bytes, urlencode
 
 import aiohttp
 from aiohttp import web
 from aiohttp.typedefs import LooseHeaders
 from loguru import logger
 from multidict import CIMultiDict
-from pydantic import (AnyUrl, BaseModel, Field, HttpUrl, IPvAnyAddress,
-                      NonNegativeFloat, NonNegativeInt, StringConstraints,
-                      TypeAdapter)
+from pydantic import (AnyUrl, BaseModel, ConfigDict, Field, HttpUrl,
+                      IPvAnyAddress, NonNegativeFloat, NonNegativeInt, PositiveFloat,
+                      PositiveInt, StringConstraints, TypeAdapter)
 from pydantic_core import to_jsonable_python
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
 Gjp2Str = Annotated[str, StringConstraints(to_lower=True, pattern="^[0-9a-f]{40}$")]
 OFFICIAL_SERVER = "https://www.boomlings.com/database"
-
-
-def pydantic_dump(*args: Any, **kw: Any) -> None:
-    json.dump(*args, separators=(",", ":"), default=to_jsonable_python, **kw)
+READ_CHUNK_SIZE = 64 * 1024
+SAVE_FILES = ("CCGameManager.xml.gz", "CCLocalLevels.xml.gz")
+SYNC_SUFFIX = b";21;30;a;a"
+# 在 </d> 处按内容分块，插入或删除关卡不会影响其他块
+CDC_ANCHOR = re.compile(rb"</d>")
+CDC_WINDOW = 64
+CDC_MASK = 0x3f
+CDC_MIN_SIZE = 8 * 1024
+CDC_MAX_SIZE = 256 * 1024
+# 二进制元数据的文件头：魔数和时间
+METADATA_HEADER = struct.Struct("<4sd")
+METADATA_MAGIC = b"GDM1"
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+M = TypeVar("M", bound="TimedItem")
+B = TypeVar("B", bound=BaseModel)
+T = TypeVar("T")
+
+
+def pydantic_dumps(*args: Any, **kw: Any) -> str:
+    return json.dumps(*args, separators=(",", ":"), default=to_jsonable_python, **kw)
 
 
 def try_scandir(path: str) -> Generator[os.DirEntry[str], Any, Any]:
@@ -44,6 +89,644 @@ def try_remove(path: str) -> None:
         pass
 
 
+def read_file(path: str, mode: str = "rb") -> Any:
+    with open(path, mode) as f:
+        return f.read()
+
+
+def replace_file(path: str, data: str | bytes) -> None:
+    # 先写入临时文件再替换，其他线程和进程不会读到写了一半的文件，同时写入同一个文件也不会冲突
+    fd, temp = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path) or ".")
+    try:
+        with open(fd, "wb") as f:
+            f.write(data.encode() if isinstance(data, str) else data)
+        os.replace(temp, path)
+    except BaseException:
+        try_remove(temp)
+        raise
+
+
+def read_small_file(path: str) -> bytes:
+    # 元数据文件很小，直接用 os.read 可以省去创建缓冲文件对象的开销
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        chunks = []
+        while chunk := os.read(fd, READ_CHUNK_SIZE):
+            chunks.append(chunk)
+        return b"".join(chunks)
+    finally:
+        os.close(fd)
+
+
+def write_file(path: str, data: str | bytes) -> None:
+    if dir := os.path.dirname(path):
+        os.makedirs(dir, exist_ok=True)
+    with open(path, "wb" if isinstance(data, bytes) else "w") as f:
+        f.write(data)
+
+
+class FileIO:
+    def __init__(self, workers: int = 4) -> None:
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="file-io")
+        self.pending = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return max(self.pending - self.workers, 0)
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.pending -= 1
+
+    async def read_bytes(self, path: str) -> bytes:
+        return await self.run(read_file, path)
+
+    async def read_text(self, path: str) -> str:
+        return await self.run(read_file, path, "r")
+
+    async def write(self, path: str, data: str | bytes) -> None:
+        await self.run(write_file, path, data)
+
+    async def exists(self, path: str) -> bool:
+        return await self.run(os.path.exists, path)
+
+    async def remove(self, path: str) -> None:
+        await self.run(try_remove, path)
+
+    def shutdown(self) -> None:
+        self.executor.shutdown()
+
+
+@contextmanager
+def file_lock(path: str) -> Generator[None, None, None]:
+    # 多进程模式下同一个帐号的存档可能被不同进程同时写入，关闭文件时自动释放
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+# 多进程模式下用文件锁选出一个进程负责预载下载和备份上传，它退出后由其他进程接替
+class Leadership:
+    def __init__(self, path: str | None, interval: float = 1) -> None:
+        self.path = path
+        self.interval = interval
+        self.file: Any = None
+        self.event = asyncio.Event()
+        if path is None:
+            self.event.set()
+
+    @property
+    def shared(self) -> bool:
+        return self.path is not None
+
+    @property
+    def is_leader(self) -> bool:
+        return self.event.is_set()
+
+    def try_acquire(self) -> bool:
+        assert self.path is not None and fcntl is not None
+        f = open(self.path, "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        self.file = f
+        return True
+
+    async def run(self, io: FileIO) -> None:
+        if self.is_leader:
+            return
+        while not await io.run(self.try_acquire):
+            await asyncio.sleep(self.interval)
+        logger.info(f"进程 {os.getpid()} 开始负责预载下载和备份上传")
+        self.event.set()
+
+    async def wait(self) -> None:
+        await self.event.wait()
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+
+
+# 多进程模式下其他进程把任务写成文件交给 leader 处理，同名的任务只保留最新的
+class Spool(Generic[B]):
+    def __init__(self, model: type[B], dir: str, interval: float = 1) -> None:
+        self.model = model
+        self.dir = dir
+        self.interval = interval
+
+    def put(self, name: str, item: B) -> None:
+        os.makedirs(self.dir, exist_ok=True)
+        replace_file(f"{self.dir}/{name}.json", item.model_dump_json())
+
+    def take(self) -> list[tuple[str, B]]:
+        items = []
+        for file in try_scandir(self.dir):
+            if not file.name.endswith(".json"):
+                continue
+            # 先改名再读取，读取期间写入的新任务不会被误删
+            taken = f"{file.path}.{os.getpid()}.{threading.get_ident()}.taken"
+            try:
+                os.replace(file.path, taken)
+            except FileNotFoundError:
+                continue
+            try:
+                items.append((file.name.removesuffix(".json"), self.model.model_validate_json(read_file(taken))))
+            except ValueError as e:
+                logger.warning(f"无法读取任务 {file.path}: {e}")
+            finally:
+                try_remove(taken)
+        return items
+
+
+class LruCache(Generic[K, V]):
+    def __init__(self, max_entries: int | None, max_bytes: int) -> None:
+        self.entries: OrderedDict[K, tuple[V, int, float | None]] = OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+
+    def get(self, key: K) -> V | None:
+        try:
+            value, size, expires = self.entries[key]
+        except KeyError:
+            return None
+        if expires is not None and time.time() >= expires:
+            self.pop(key)
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key: K, value: V, size: int, expires: float | None = None) -> None:
+        self.pop(key)
+        if size > self.max_bytes or self.max_entries == 0:
+            return
+        self.entries[key] = (value, size, expires)
+        self.bytes += size
+        while (self.max_entries is not None and len(self.entries) > self.max_entries) or self.bytes > self.max_bytes:
+            _, (_, size, _) = self.entries.popitem(last=False)
+            self.bytes -= size
+
+    def pop(self, key: K) -> None:
+        if (entry := self.entries.pop(key, None)) is not None:
+            self.bytes -= entry[1]
+
+
+class SingleFlight(Generic[K, T]):
+    def __init__(self) -> None:
+        self.calls: dict[K, asyncio.Future[T]] = {}
+        self.coalesced = 0
+
+    async def do(self, key: K, func: Callable[[], Awaitable[T]]) -> T:
+        # 相同的并发调用共用一次执行结果，发起者断开也不会中断其他等待者
+        if (future := self.calls.get(key)) is None:
+            future = self.calls[key] = asyncio.ensure_future(func())
+            future.add_done_callback(lambda _: self.calls.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(future)
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    TYPE: ClassVar[str]
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        METRICS.append(self)
+
+    def format_labels(self, values: tuple[str, ...], extra: str = "") -> str:
+        labels = [f'{k}="{escape_label(v)}"' for k, v in zip(self.labels, values)]
+        if extra:
+            labels.append(extra)
+        return "{" + ",".join(labels) + "}" if labels else ""
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "".join(f"{line}\n" for line in (f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}", *self.samples()))
+
+
+# 指标只在事件循环线程中更新，直接用普通的数字累加，不需要加锁
+class Counter(Metric):
+    TYPE = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, labels)
+        self.values: defaultdict[tuple[str, ...], float] = defaultdict(float)
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self.values[labels] += amount
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self.values.items():
+            yield f"{self.name}{self.format_labels(labels)} {value}"
+
+
+class Gauge(Counter):
+    TYPE = "gauge"
+
+    def set(self, value: float, *labels: str) -> None:
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        self.counts: dict[tuple[str, ...], list[int]] = {}
+        self.sums: defaultdict[tuple[str, ...], float] = defaultdict(float)
+
+    def observe(self, value: float, *labels: str) -> None:
+        if (counts := self.counts.get(labels)) is None:
+            counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    def samples(self) -> Iterable[str]:
+        for labels, counts in self.counts.items():
+            for bound, count in zip((*map(str, self.buckets), "+Inf"), itertools.accumulate(counts)):
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{self.format_labels(labels, le)} {count}"
+            yield f"{self.name}_sum{self.format_labels(labels)} {self.sums[labels]}"
+            yield f"{self.name}_count{self.format_labels(labels)} {sum(counts)}"
+
+
+METRICS: list[Metric] = []
+HTTP_LATENCY = Histogram("gd_http_request_duration_seconds", "处理请求的时间", ("route",))
+HTTP_RESPONSES = Counter("gd_http_responses_total", "返回的响应数", ("route", "status"))
+UPSTREAM_LATENCY = Histogram("gd_upstream_request_duration_seconds", "请求游戏服务器 API 直到收到响应头的时间（包括重试）", ("api",))
+UPSTREAM_RESPONSES = Counter("gd_upstream_responses_total", "游戏服务器 API 的响应数", ("api", "status"))
+UPSTREAM_UP = Gauge("gd_upstream_up", "健康检查认为上游是否可用", ("upstream",))
+CACHE_REQUESTS = Counter("gd_cache_requests_total", "缓存查询次数", ("cache", "result"))
+CACHE_EXPIRED = Counter("gd_cache_expired_total", "过期删除的缓存数", ("cache",))
+CACHE_EVICTED = Counter("gd_cache_evicted_total", "因占用超出限制而删除的缓存数", ("cache",))
+PREFETCH_QUEUE = Gauge("gd_prefetch_queue_depth", "等待下载的预载任务数")
+PREFETCH_QUEUE_WAIT = Histogram("gd_prefetch_queue_wait_seconds", "预载任务等待下载的时间", ("priority",))
+PREFETCH_PREDICTED = Counter("gd_prefetch_predicted_total", "根据关卡列表预测的音乐数", ("result",))
+PREFETCH_DISK = Gauge("gd_prefetch_disk_bytes", "预载文件占用的磁盘空间", ("type",))
+PREFETCH_DOWNLOADED = Counter("gd_prefetch_downloaded_bytes_total", "预载下载的字节数", ("type",))
+PREFETCH_ACTIVE = Gauge("gd_prefetch_active_tasks", "正在下载的预载任务数", ("type",))
+PREFETCH_IN_FLIGHT = Gauge("gd_prefetch_bytes_in_flight", "正在下载的预载任务已经下载的字节数", ("type",))
+PREFETCH_BUFFERED = Gauge("gd_prefetch_buffered_bytes", "正在下载的预载任务在内存中保留的字节数", ("type",))
+BACKUP_QUEUE = Gauge("gd_backup_queue_depth", "等待上传的备份数", ("state",))
+IO_QUEUE = Gauge("gd_io_queue_depth", "排队中的文件操作数")
+POOL_USAGE = Gauge("gd_pool_requests", "连接池中的请求数", ("pool", "state"))
+LOOP_LAG = Histogram("gd_event_loop_lag_seconds", "事件循环的延迟", buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+LOOP_LAG_INTERVAL = 1
+# 指标的 api 标签只使用已知的 API，其他路径由客户端决定，都记为 other
+KNOWN_APIS = frozenset({
+    "accounts/loginGJAccount", "accounts/registerGJAccount", "accounts/backupGJAccountNew", "accounts/syncGJAccountNew",
+    "getAccountURL", "getCustomContentURL", "getGJSongInfo", "getGJTopArtists",
+    "getGJLevels21", "downloadGJLevel22", "getGJDailyLevel", "getGJMapPacks21", "getGJGauntlets21", "getGJLevelLists",
+    "uploadGJLevel21", "deleteGJLevelUser20", "updateGJDesc20", "uploadGJLevelList", "deleteGJLevelList",
+    "rateGJStars211", "rateGJDemon21", "suggestGJStars20", "likeGJItem211", "reportGJLevel",
+    "getGJLevelScores211", "getGJLevelScoresPlat", "getGJScores20", "updateGJUserScore22",
+    "getGJUserInfo20", "getGJUsers20", "updateGJAccSettings20", "getGJUserList20", "blockGJUser20", "unblockGJUser20", "removeGJFriend20",
+    "getGJComments21", "getGJCommentHistory", "uploadGJComment21", "deleteGJComment20",
+    "getGJAccountComments20", "uploadGJAccComment20", "deleteGJAccComment20",
+    "getGJMessages20", "downloadGJMessage20", "uploadGJMessage20", "deleteGJMessages20",
+    "getGJFriendRequests20", "uploadFriendRequest20", "acceptGJFriendRequest20", "readGJFriendRequest20", "deleteGJFriendRequests20",
+    "getGJRewards", "getGJChallenges", "getGJSecretReward", "requestUserAccess",
+})
+
+
+class Tracer:
+    def __init__(self, io: FileIO, path: str, flush_interval: float = 1) -> None:
+        self.io = io
+        self.path = path
+        self.flush_interval = flush_interval
+        self.lines: list[str] = []
+        self.file: Any = None
+
+    def emit(self, record: dict[str, Any]) -> None:
+        self.lines.append(json.dumps(record, ensure_ascii=False, default=str))
+
+    async def flush(self) -> None:
+        if not self.lines:
+            return
+        lines, self.lines = self.lines, []
+        if self.file is None:
+            self.file = await self.io.run(open, self.path, "a", -1, "utf-8")
+        await self.io.run(self.file.write, "".join(f"{line}\n" for line in lines))
+        await self.io.run(self.file.flush)
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except OSError as e:
+                logger.warning(f"写入 {self.path} 失败: {e}")
+
+    async def close(self) -> None:
+        await self.flush()
+        if self.file is not None:
+            await self.io.run(self.file.close)
+
+
+class Trace:
+    def __init__(self, tracer: Tracer, id: str) -> None:
+        self.tracer = tracer
+        self.id = id
+        self.timings: defaultdict[str, float] = defaultdict(float)
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{name};dur={duration * 1000:.1f}" for name, duration in self.timings.items())
+
+
+current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Generator[dict[str, Any], None, None]:
+    # 记录一段操作的耗时，没有开启追踪时什么都不做，可以往返回的 dict 里添加属性
+    if (trace := current_trace.get()) is None:
+        yield attrs
+        return
+    start_wall = time.time()
+    start_time = time.monotonic()
+    try:
+        yield attrs
+    except BaseException as e:
+        attrs["error"] = repr(e)
+        raise
+    finally:
+        duration = time.monotonic() - start_time
+        trace.timings[name] += duration
+        trace.tracer.emit({"request_id": trace.id, "span": name, "start": start_wall, "duration": duration, **attrs})
+
+
+class TimedItem(BaseModel):
+    time: float = Field(default_factory=time.time)
+
+    # 二进制格式中时间在文件头里，其余内容默认用 JSON，读取频繁的类型自行实现更紧凑的格式
+    def pack_body(self) -> bytes:
+        return self.model_dump_json(exclude={"time"}).encode()
+
+    @classmethod
+    def unpack_body(cls: type[M], item_time: float, body: bytes) -> M:
+        return cls.model_validate({**json.loads(body), "time": item_time})
+
+
+class MetadataStore(Generic[M]):
+    def __init__(self, model: type[M], name: str) -> None:
+        self.model = model
+        self.name = name
+
+    def load(self, id: int) -> M | None:
+        raise NotImplementedError
+
+    def save(self, id: int, item: M) -> None:
+        raise NotImplementedError
+
+    def remove(self, id: int) -> None:
+        raise NotImplementedError
+
+    def remove_many(self, ids: list[int]) -> None:
+        for id in ids:
+            self.remove(id)
+
+    def remove_expired(self, ids: list[int], before: float) -> list[int]:
+        # 多个进程共用存储时，其他进程可能已经刷新了这些元数据，删除前要重新检查时间
+        removed = []
+        for id in ids:
+            try:
+                item = self.load(id)
+            except (ValueError, struct.error):
+                # 读不出来的也删掉
+                item = None
+            else:
+                if item is None or item.time >= before:
+                    continue
+            self.remove(id)
+            removed.append(id)
+        return removed
+
+    def scan(self) -> Generator[tuple[int, float], Any, Any]:
+        raise NotImplementedError
+
+    def ids(self) -> Generator[int, Any, Any]:
+        for id, _ in self.scan():
+            yield id
+
+    def migrate(self, old: "MetadataStore[M]") -> int:
+        # 把其他存储方式中的元数据转移过来
+        count = 0
+        for id in list(old.ids()):
+            try:
+                item = old.load(id)
+            except (ValueError, struct.error) as e:
+                logger.warning(f"无法读取 {old.name} 中 {id} 的元数据，已跳过: {e}")
+                continue
+            if item is not None:
+                self.save(id, item)
+                count += 1
+            old.remove(id)
+        return count
+
+
+class JsonMetadataStore(MetadataStore[M]):
+    def load(self, id: int) -> M | None:
+        try:
+            with open(f"{self.name}/{id}.json") as f:
+                return self.model.model_validate(json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def save(self, id: int, item: M) -> None:
+        os.makedirs(self.name, exist_ok=True)
+        replace_file(f"{self.name}/{id}.json", pydantic_dumps(item))
+
+    def remove(self, id: int) -> None:
+        try_remove(f"{self.name}/{id}.json")
+
+    def scan(self) -> Generator[tuple[int, float], Any, Any]:
+        for file in try_scandir(self.name):
+            if not file.name.endswith(".json"):
+                continue
+            with open(file.path) as f:
+                yield int(file.name.removesuffix(".json")), self.model.model_validate(json.load(f)).time
+
+    def ids(self) -> Generator[int, Any, Any]:
+        for file in try_scandir(self.name):
+            if file.name.endswith(".json"):
+                yield int(file.name.removesuffix(".json"))
+
+
+# 每项一个文件，定长文件头后面是二进制内容，读取时不需要解析 JSON 和校验
+class BinaryMetadataStore(MetadataStore[M]):
+    def path(self, id: int) -> str:
+        return f"{self.name}/{id}.meta"
+
+    def load(self, id: int) -> M | None:
+        try:
+            data = read_small_file(self.path(id))
+        except FileNotFoundError:
+            return None
+        magic, item_time = METADATA_HEADER.unpack_from(data)
+        if magic != METADATA_MAGIC:
+            raise ValueError(f"{self.path(id)} 不是有效的元数据文件")
+        return self.model.unpack_body(item_time, data[METADATA_HEADER.size:])
+
+    def save(self, id: int, item: M) -> None:
+        os.makedirs(self.name, exist_ok=True)
+        replace_file(self.path(id), METADATA_HEADER.pack(METADATA_MAGIC, item.time) + item.pack_body())
+
+    def remove(self, id: int) -> None:
+        try_remove(self.path(id))
+
+    def scan(self) -> Generator[tuple[int, float], Any, Any]:
+        # 只读文件头
+        for file in try_scandir(self.name):
+            if not file.name.endswith(".meta"):
+                continue
+            # 其他进程可能刚好删除了这个文件
+            try:
+                with open(file.path, "rb") as f:
+                    _, item_time = METADATA_HEADER.unpack(f.read(METADATA_HEADER.size))
+            except FileNotFoundError:
+                continue
+            except struct.error:
+                logger.warning(f"{file.path} 不是有效的元数据文件")
+                continue
+            yield int(file.name.removesuffix(".meta")), item_time
+
+    def ids(self) -> Generator[int, Any, Any]:
+        for file in try_scandir(self.name):
+            if file.name.endswith(".meta"):
+                yield int(file.name.removesuffix(".meta"))
+
+
+class SqliteMetadataStore(MetadataStore[M]):
+    def __init__(self, model: type[M], name: str, db: sqlite3.Connection, lock: threading.Lock) -> None:
+        super().__init__(model, name)
+        self.db = db
+        self.lock = lock
+        with self.lock:
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS {name} (id INTEGER PRIMARY KEY, time REAL NOT NULL, data TEXT NOT NULL)")
+
+    @staticmethod
+    def connect(path: str) -> sqlite3.Connection:
+        db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def load(self, id: int) -> M | None:
+        with self.lock:
+            row = self.db.execute(f"SELECT data FROM {self.name} WHERE id = ?", (id,)).fetchone()
+        return None if row is None else self.model.model_validate_json(row[0])
+
+    def save(self, id: int, item: M) -> None:
+        with self.lock:
+            self.db.execute(f"INSERT OR REPLACE INTO {self.name} (id, time, data) VALUES (?, ?, ?)", (id, item.time, item.model_dump_json()))
+
+    def remove(self, id: int) -> None:
+        with self.lock:
+            self.db.execute(f"DELETE FROM {self.name} WHERE id = ?", (id,))
+
+    def remove_many(self, ids: list[int]) -> None:
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(f"DELETE FROM {self.name} WHERE id = ?", ((id,) for id in ids))
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def remove_expired(self, ids: list[int], before: float) -> list[int]:
+        removed = []
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for id in ids:
+                    if self.db.execute(f"DELETE FROM {self.name} WHERE id = ? AND time < ?", (id, before)).rowcount:
+                        removed.append(id)
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+        return removed
+
+    def scan(self) -> Generator[tuple[int, float], Any, Any]:
+        with self.lock:
+            rows = self.db.execute(f"SELECT id, time FROM {self.name}").fetchall()
+        yield from rows
+
+
+class Expirable:
+    async def expire(self, ids: list[int]) -> None:
+        raise NotImplementedError
+
+
+class ExpiryScheduler:
+    def __init__(self, interval: float = 1, batch: int = 1000) -> None:
+        self.interval = interval
+        self.batch = batch
+        self.heap: list[tuple[float, int, int, Expirable]] = []
+        self.deadlines: dict[tuple[Expirable, int], float] = {}
+        self.counter = itertools.count()
+        # 上游不可用时暂停删除过期缓存，降级模式下还要用
+        self.paused = False
+
+    def schedule(self, owner: Expirable, id: int, delay: float) -> None:
+        when = time.time() + delay
+        self.deadlines[owner, id] = when
+        heapq.heappush(self.heap, (when, next(self.counter), id, owner))
+        # 重新调度会在堆里留下失效的项，过多时重建堆
+        if len(self.heap) > 2 * len(self.deadlines) + 1024:
+            self.heap = [(when, next(self.counter), id, owner) for (owner, id), when in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def cancel(self, owner: Expirable, id: int) -> None:
+        self.deadlines.pop((owner, id), None)
+
+    async def sweep(self) -> int:
+        current_time = time.time()
+        expired: defaultdict[Expirable, list[int]] = defaultdict(list)
+        count = 0
+        while self.heap and self.heap[0][0] <= current_time and count < self.batch:
+            when, _, id, owner = heapq.heappop(self.heap)
+            if self.deadlines.get((owner, id)) != when:
+                continue
+            del self.deadlines[owner, id]
+            expired[owner].append(id)
+            count += 1
+        for owner, ids in expired.items():
+            try:
+                await owner.expire(ids)
+            except Exception:
+                logger.exception("删除过期缓存失败")
+        return count
+
+    async def run(self) -> None:
+        while True:
+            # 一次删不完时不等待，直接进入下一批
+            if self.paused or await self.sweep() < self.batch:
+                await asyncio.sleep(self.interval)
+            else:
+                await asyncio.sleep(0)
+
+
 class Gjp2Mode(Enum):
     AUTO = "auto"
     IGNORE = "ignore"
@@ -53,7 +736,7 @@ class Auth(BaseModel):
     fetch_gjp2: bool = True
     gjp2_override: dict[int, Gjp2Str | Gjp2Mode] = Field(default_factory=dict)
 
-    def write_gjp2(self, account_id: int, gjp2: Gjp2Str) -> None:
+    async def write_gjp2(self, io: FileIO, account_id: int, gjp2: Gjp2Str) -> None:
         if not self.has_account(account_id):
             return
         if account_id in self.gjp2_override:
@@ -61,11 +744,9 @@ class Auth(BaseModel):
         else:
             fetch_gjp2 = self.fetch_gjp2
         if fetch_gjp2:
-            os.makedirs(f"accounts/{account_id}", exist_ok=True)
-            with open(f"accounts/{account_id}/gjp2.txt", "w") as f:
-                f.write(gjp2)
+            await io.write(f"accounts/{account_id}/gjp2.txt", gjp2)
 
-    def validate_gjp2(self, account_id: int, gjp2: Gjp2Str) -> bool:
+    async def validate_gjp2(self, io: FileIO, account_id: int, gjp2: Gjp2Str) -> bool:
         if not self.has_account(account_id):
             return False
         account_gjp2 = self.gjp2_override.get(account_id, Gjp2Mode.AUTO if self.fetch_gjp2 else Gjp2Mode.IGNORE)
@@ -73,8 +754,7 @@ class Auth(BaseModel):
             return True
         if account_gjp2 == Gjp2Mode.AUTO:
             try:
-                with open(f"accounts/{account_id}/gjp2.txt") as f:
-                    account_gjp2 = f.readline().rstrip()
+                account_gjp2 = (await io.read_text(f"accounts/{account_id}/gjp2.txt")).split("\n", 1)[0].rstrip()
             except FileNotFoundError:
                 return False
         return gjp2 == account_gjp2
@@ -99,35 +779,116 @@ class WhitelistAuth(Auth):
         return account_id in self.whitelist
 
 
+class ConnectionPoolConfig(BaseModel):
+    limit: NonNegativeInt = 100
+    limit_per_host: NonNegativeInt = 0
+    keepalive_timeout: NonNegativeFloat = 15
+    dns_cache_ttl: None | NonNegativeInt = 10
+    connect_timeout: None | PositiveFloat = 10
+    read_timeout: None | PositiveFloat = None
+    total_timeout: None | PositiveFloat = None
+
+
+class ResponseCacheRule(BaseModel):
+    ttl: NonNegativeFloat
+    stale_while_revalidate: NonNegativeFloat = 0
+    stale_if_error: NonNegativeFloat = 86400
+    # 结果与请求者有关（如好友状态）的接口，不同凭据分开缓存
+    per_viewer: bool = False
+    # 参数为这些值时才与请求者有关，如好友的关卡列表
+    per_viewer_values: dict[str, set[str]] = Field(default_factory=dict)
+
+
+def default_response_cache() -> dict[str, ResponseCacheRule]:
+    return {
+        "getGJLevels21": ResponseCacheRule(ttl=30, stale_while_revalidate=30, per_viewer_values={"type": {"13"}}),
+        "getGJMapPacks21": ResponseCacheRule(ttl=600, stale_while_revalidate=600),
+        "getGJGauntlets21": ResponseCacheRule(ttl=600, stale_while_revalidate=600),
+        "getGJDailyLevel": ResponseCacheRule(ttl=30),
+        "getGJUserInfo20": ResponseCacheRule(ttl=30, stale_while_revalidate=30, per_viewer=True),
+    }
+
+
 class Config(BaseModel):
     host: IPvAnyAddress = Field(default="0.0.0.0")
     port: int = Field(default=80, ge=0, lt=65536)
     game_server: HttpUrl = Field(default=OFFICIAL_SERVER)
     game_retry_count: None | NonNegativeInt = 4
     game_retry_4xx: bool = False
+    game_retry_backoff: NonNegativeFloat = 0.5
+    game_retry_deadline: None | PositiveFloat = None
     game_proxy: None | HttpUrl = None
+    game_pool: ConnectionPoolConfig = Field(default_factory=lambda: ConnectionPoolConfig(limit=32, keepalive_timeout=30, total_timeout=60))
+    response_cache: dict[str, ResponseCacheRule] = Field(default_factory=default_response_cache)
+    response_cache_bytes: NonNegativeInt = 16 * 1024 * 1024
+    response_cache_ignored_fields: set[str] = Field(default_factory=lambda: {"gjp", "gjp2", "uuid", "udid"})
     backup_enabled: bool | Literal["local"] = True
     backup_server: None | HttpUrl = None
     backup_retry_count: None | NonNegativeInt = None
     backup_retry_interval: NonNegativeFloat = 60
     backup_retry_4xx: bool = False
     backup_proxy: None | HttpUrl = None
+    backup_pool: ConnectionPoolConfig = Field(default_factory=lambda: ConnectionPoolConfig(limit=4, read_timeout=300))
+    backup_max_size: PositiveInt = 30 * 1024 * 1024
+    backup_history_count: NonNegativeInt = 10
+    backup_upload_concurrency: PositiveInt = 2
+    backup_upload_rate: None | PositiveInt = None
+    backup_journal_flush_interval: PositiveFloat = 1
+    backup_journal_compact_size: PositiveInt = 1000
     backup_auth: BlacklistAuth | WhitelistAuth = Field(default_factory=lambda: BlacklistAuth(type="blacklist"))
     song_enabled: bool = True
     song_retry_count: None | NonNegativeInt = 4
     song_retry_4xx: bool = False
+    song_retry_backoff: NonNegativeFloat = 1
+    song_retry_deadline: None | PositiveFloat = None
     song_proxy: None | HttpUrl = None
     song_info_ttl: None | NonNegativeFloat = 600
+    song_info_memory_entries: NonNegativeInt = 4096
+    song_info_memory_bytes: NonNegativeInt = 4 * 1024 * 1024
+    level_cache: bool = False
+    level_cache_ttl: None | NonNegativeFloat = 86400
+    level_cache_compress_level: int = Field(default=6, ge=0, le=9)
+    metadata_backend: Literal["binary", "json", "sqlite"] = "binary"
+    metadata_db: str = "metadata.db"
+    expiry_sweep_interval: PositiveFloat = 1
+    expiry_sweep_batch: PositiveInt = 1000
+    io_workers: PositiveInt = 4
+    trace: bool = False
+    trace_file: str = "traces.jsonl"
+    trace_flush_interval: PositiveFloat = 1
+    trace_server_timing: bool = False
     assets_enabled: bool = True
     assets_server: None | HttpUrl = None
     assets_retry_count: None | NonNegativeInt = 4
     assets_retry_4xx: bool = False
+    assets_retry_backoff: NonNegativeFloat = 1
+    assets_retry_deadline: None | PositiveFloat = None
     assets_proxy: None | HttpUrl = None
     assets_server_ttl: None | NonNegativeFloat = 600
+    retry_backoff_max: NonNegativeFloat = 10
+    retry_jitter: float = Field(default=0.5, ge=0, le=1)
+    circuit_breaker_threshold: NonNegativeInt = 5
+    circuit_breaker_timeout: PositiveFloat = 30
+    health_probe: bool = True
+    health_probe_interval: PositiveFloat = 10
+    health_probe_timeout: PositiveFloat = 5
+    health_probe_failures: PositiveInt = 2
     ngproxy: bool = True
+    ngproxy_pool: ConnectionPoolConfig = Field(default_factory=lambda: ConnectionPoolConfig(limit=16, connect_timeout=5, read_timeout=30))
+    media_pool: ConnectionPoolConfig = Field(default_factory=lambda: ConnectionPoolConfig(limit=32, read_timeout=60))
+    ngproxy_hedge: bool = False
+    ngproxy_hedge_delay: None | NonNegativeFloat = None
     prefetch: bool = True
     prefetch_ttl: None | NonNegativeFloat = 600
+    prefetch_max_bytes: None | NonNegativeInt = None
+    prefetch_concurrency: PositiveInt = 8
+    prefetch_predictive: bool = False
+    prefetch_predictive_count: PositiveInt = 5
+    prefetch_predictive_window: PositiveFloat = 3600
+    prefetch_predictive_client_bytes: NonNegativeInt = 64 * 1024 * 1024
+    prefetch_predictive_global_bytes: NonNegativeInt = 1024 * 1024 * 1024
     prefetch_target_dir: None | str = None
+    prefetch_buffer_size: NonNegativeInt = 1024 * 1024
 
     @property
     def backup_server_repr(self) -> str:
@@ -157,7 +918,8 @@ class Config(BaseModel):
 
 class BackupTask(BaseModel):
     time: float = Field(default_factory=time.time)
-    server: HttpUrl
+    # None 表示暂时无法获取备份服务器，上传前再查询
+    server: HttpUrl | None
     token: dict[str, str]
     retry_left: NonNegativeInt | None
 
@@ -166,52 +928,592 @@ class BackupTask(BaseModel):
         return str(self.server).removesuffix("/")
 
 
+def open_temp(dir: str) -> Any:
+    os.makedirs(dir, exist_ok=True)
+    return tempfile.NamedTemporaryFile("wb", dir=dir, delete=False)
+
+
+class SaveUploadParser:
+    FIELD_LIMIT = 64 * 1024
+    NOT_BASE64 = bytes(set(range(256)) - set(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/-_=;"))
+
+    def __init__(self, io: FileIO, tmp_dir: str = "accounts/.tmp") -> None:
+        self.io = io
+        self.tmp_dir = tmp_dir
+        self.form: dict[str, str] = {}
+        self.files: list[str] = []
+        self.key = bytearray()
+        self.value = bytearray()
+        self.in_value = False
+        self.is_save = False
+        self.percent = b""
+        self.base64 = bytearray()
+        self.file: Any = None
+
+    async def feed(self, chunk: bytes) -> None:
+        pos = 0
+        while pos < len(chunk):
+            amp = chunk.find(b"&", pos)
+            if not self.in_value:
+                eq = chunk.find(b"=", pos)
+                if eq == -1 or (amp != -1 and amp < eq):
+                    end = len(chunk) if amp == -1 else amp
+                    self.key += chunk[pos:end]
+                    if len(self.key) > self.FIELD_LIMIT:
+                        raise ValueError("表单字段过长")
+                    if amp == -1:
+                        return
+                    await self.end_field()
+                    pos = amp + 1
+                    continue
+                self.key += chunk[pos:eq]
+                self.in_value = True
+                self.is_save = self.key == b"saveData"
+                pos = eq + 1
+                continue
+            end = len(chunk) if amp == -1 else amp
+            await self.feed_value(chunk[pos:end])
+            if amp == -1:
+                return
+            await self.end_field()
+            pos = amp + 1
+
+    async def feed_value(self, data: bytes) -> None:
+        data = self.percent + data
+        # 被切断的 %XX 留到下一块再解码
+        if (i := data.rfind(b"%", max(len(data) - 2, 0))) != -1:
+            data, self.percent = data[:i], data[i:]
+        else:
+            self.percent = b""
+        data = unquote_to_bytes(data.replace(b"+", b" "))
+        if not self.is_save:
+            self.value += data
+            if len(self.value) > self.FIELD_LIMIT:
+                raise ValueError("表单字段过长")
+            return
+        parts = data.translate(None, self.NOT_BASE64).split(b";")
+        for i, part in enumerate(parts):
+            if i:
+                await self.close_file()
+            if self.file is None:
+                await self.open_file()
+            self.base64 += part
+            size = len(self.base64) // 4 * 4
+            if size:
+                await self.io.run(self.file.write, base64.urlsafe_b64decode(bytes(self.base64[:size])))
+                del self.base64[:size]
+
+    async def open_file(self) -> None:
+        if len(self.files) >= len(SAVE_FILES):
+            raise ValueError("存档数据格式错误")
+        self.file = await self.io.run(open_temp, self.tmp_dir)
+        self.files.append(self.file.name)
+
+    async def close_file(self) -> None:
+        if self.file is None:
+            await self.open_file()
+        if self.base64:
+            # 补齐省略的 padding
+            await self.io.run(self.file.write, base64.urlsafe_b64decode(bytes(self.base64) + b"=" * (-len(self.base64) % 4)))
+            self.base64.clear()
+        await self.io.run(self.file.close)
+        self.file = None
+
+    async def end_field(self) -> None:
+        if self.percent:
+            raise ValueError("表单编码错误")
+        if self.is_save:
+            await self.close_file()
+        else:
+            self.form[unquote_plus(self.key.decode())] = self.value.decode(errors="replace")
+        self.key.clear()
+        self.value.clear()
+        self.in_value = self.is_save = False
+
+    async def finish(self) -> None:
+        if self.key or self.in_value:
+            await self.end_field()
+        if len(self.files) != len(SAVE_FILES):
+            raise ValueError("存档数据格式错误")
+
+    def commit(self, account_id: int) -> None:
+        os.makedirs(f"accounts/{account_id}", exist_ok=True)
+        with file_lock(f"accounts/{account_id}/.lock"):
+            for path, name in zip(self.files, SAVE_FILES):
+                os.replace(path, f"accounts/{account_id}/{name}")
+            self.files.clear()
+            build_sync_payload(account_id)
+
+    async def cleanup(self) -> None:
+        if self.file is not None:
+            await self.io.run(self.file.close)
+            self.file = None
+        for path in self.files:
+            await self.io.remove(path)
+        self.files.clear()
+
+
+def build_sync_payload(account_id: int) -> str:
+    # 预先生成 syncGJAccountNew 的响应，同步时直接发送文件
+    dir = f"accounts/{account_id}"
+    with tempfile.NamedTemporaryFile("wb", dir=dir, delete=False) as out:
+        try:
+            for i, name in enumerate(SAVE_FILES):
+                if i:
+                    out.write(b";")
+                with open(f"{dir}/{name}", "rb") as f:
+                    while chunk := f.read(READ_CHUNK_SIZE * 3):
+                        out.write(base64.urlsafe_b64encode(chunk))
+            out.write(SYNC_SUFFIX)
+        except BaseException:
+            try_remove(out.name)
+            raise
+    os.replace(out.name, f"{dir}/sync.txt")
+    return f"{dir}/sync.txt"
+
+
+def get_sync_payload(account_id: int) -> str:
+    path = f"accounts/{account_id}/sync.txt"
+    if os.path.exists(path):
+        return path
+    return build_sync_payload(account_id)
+
+
+def open_save_data(account_id: int) -> tuple[Any, int, int]:
+    # 返回 saveData 的原始长度和 URL 编码后的长度，base64 中只有 = 和 ; 需要编码
+    f = open(get_sync_payload(account_id), "rb")
+    try:
+        size = os.fstat(f.fileno()).st_size - len(SYNC_SUFFIX)
+        encoded_size = size
+        remaining = size
+        while remaining > 0 and (chunk := f.read(min(READ_CHUNK_SIZE, remaining))):
+            remaining -= len(chunk)
+            encoded_size += 2 * (chunk.count(b"=") + chunk.count(b";"))
+        f.seek(0)
+    except BaseException:
+        f.close()
+        raise
+    return f, size, encoded_size
+
+
+def content_defined_chunks(f: Any) -> Generator[bytes, Any, Any]:
+    # 每次只读入一个最大分块的数据，不需要把整个文件读入内存
+    data = bytearray()
+    eof = False
+    while True:
+        while not eof and len(data) < CDC_MAX_SIZE:
+            if not (block := f.read(READ_CHUNK_SIZE)):
+                eof = True
+            data += block
+        if not data:
+            return
+        limit = min(CDC_MAX_SIZE, len(data))
+        cut = limit
+        pos = CDC_MIN_SIZE
+        while pos < limit and (match := CDC_ANCHOR.search(data, pos, limit)):
+            end = match.end()
+            if zlib.crc32(data[max(end - CDC_WINDOW, 0):end]) & CDC_MASK == 0:
+                cut = end
+                break
+            pos = end
+        yield bytes(data[:cut])
+        del data[:cut]
+
+
+class SaveFileManifest(BaseModel):
+    size: int
+    sha256: str
+    gzip: bool
+    chunks: list[str]
+
+
+class SaveVersion(BaseModel):
+    time: float = Field(default_factory=time.time)
+    files: dict[str, SaveFileManifest]
+
+
+class SaveHistory:
+    def __init__(self, io: FileIO, keep: int = 10) -> None:
+        self.io = io
+        self.keep = keep
+        self.locks: dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self.pending: set[asyncio.Task[Any]] = set()
+
+    @staticmethod
+    def dir(account_id: int) -> str:
+        return f"accounts/{account_id}/history"
+
+    def versions(self, account_id: int) -> list[int]:
+        return sorted(int(file.name.removesuffix(".json")) for file in try_scandir(self.dir(account_id)) if file.name.endswith(".json"))
+
+    def load(self, account_id: int, version: int) -> SaveVersion:
+        return SaveVersion.model_validate_json(read_file(f"{self.dir(account_id)}/{version}.json"))
+
+    def store_file(self, account_id: int, name: str) -> SaveFileManifest:
+        # gzip 的输出牵一发而动全身，解压后再分块才能去重
+        chunks = []
+        size = 0
+        sha256 = hashlib.sha256()
+        os.makedirs(f"{self.dir(account_id)}/chunks", exist_ok=True)
+        with open(f"accounts/{account_id}/{name}", "rb") as f:
+            is_gzip = f.read(2) == b"\x1f\x8b"
+            f.seek(0)
+            with gzip.GzipFile(fileobj=f) if is_gzip else f as source:
+                for chunk in content_defined_chunks(source):
+                    size += len(chunk)
+                    sha256.update(chunk)
+                    digest = hashlib.sha256(chunk).hexdigest()
+                    path = f"{self.dir(account_id)}/chunks/{digest}"
+                    if not os.path.exists(path):
+                        replace_file(path, zlib.compress(chunk))
+                    chunks.append(digest)
+        return SaveFileManifest(size=size, sha256=sha256.hexdigest(), gzip=is_gzip, chunks=chunks)
+
+    def record_sync(self, account_id: int) -> int | None:
+        with file_lock(f"accounts/{account_id}/.lock"):
+            files = {name: self.store_file(account_id, name) for name in SAVE_FILES}
+            versions = self.versions(account_id)
+            if versions and self.load(account_id, versions[-1]).files == files:
+                return None
+            version = versions[-1] + 1 if versions else 1
+            write_file(f"{self.dir(account_id)}/{version}.json", SaveVersion(files=files).model_dump_json())
+            self.prune(account_id)
+            return version
+
+    def prune(self, account_id: int) -> None:
+        versions = self.versions(account_id)
+        for version in versions[:max(len(versions) - self.keep, 0)]:
+            try_remove(f"{self.dir(account_id)}/{version}.json")
+        used = set()
+        for version in self.versions(account_id):
+            for file in self.load(account_id, version).files.values():
+                used.update(file.chunks)
+        for file in try_scandir(f"{self.dir(account_id)}/chunks"):
+            if file.name not in used:
+                try_remove(file.path)
+
+    def restore_sync(self, account_id: int, version: int) -> None:
+        with file_lock(f"accounts/{account_id}/.lock"):
+            save = self.load(account_id, version)
+            for name, manifest in save.files.items():
+                data = b"".join(zlib.decompress(read_file(f"{self.dir(account_id)}/chunks/{digest}")) for digest in manifest.chunks)
+                if hashlib.sha256(data).hexdigest() != manifest.sha256:
+                    raise ValueError(f"版本 {version} 的 {name} 已损坏")
+                if manifest.gzip:
+                    data = gzip.compress(data, mtime=0)
+                write_file(f"accounts/{account_id}/{name}.tmp", data)
+                os.replace(f"accounts/{account_id}/{name}.tmp", f"accounts/{account_id}/{name}")
+            build_sync_payload(account_id)
+
+    async def record(self, account_id: int) -> None:
+        async with self.locks[account_id]:
+            try:
+                version = await self.io.run(self.record_sync, account_id)
+            except Exception:
+                logger.exception(f"保存 {account_id} 的存档历史失败")
+                return
+        if version is not None:
+            logger.info(f"已保存 {account_id} 的存档历史版本 {version}")
+
+    def record_later(self, account_id: int) -> None:
+        if self.keep <= 0:
+            return
+        task = asyncio.create_task(self.record(account_id))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+
+class BackupJournalEvent(BaseModel):
+    op: Literal["schedule", "retry", "complete"]
+    account_id: int
+    time: float
+    task: BackupTask | None = None
+
+
+def append_sync(f: Any, data: bytes) -> None:
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+
+
+class BackupJournal:
+    TASKS_ADAPTER: ClassVar = TypeAdapter(dict[int, BackupTask])
+
+    def __init__(self, io: FileIO, flush_interval: float = 1, compact_size: int = 1000, path: str = "backup_tasks.journal", snapshot: str = "backup_tasks.json") -> None:
+        self.io = io
+        self.flush_interval = flush_interval
+        self.compact_size = compact_size
+        self.path = path
+        self.snapshot = snapshot
+        self.buffer: list[bytes] = []
+        self.lines = 0
+        self.file: Any = None
+        self.lock = asyncio.Lock()
+
+    def load_sync(self) -> dict[int, BackupTask]:
+        try:
+            tasks = self.TASKS_ADAPTER.validate_json(read_file(self.snapshot))
+        except FileNotFoundError:
+            tasks = {}
+        try:
+            with open(self.path, "rb") as f:
+                for line in f:
+                    try:
+                        event = BackupJournalEvent.model_validate_json(line)
+                    except ValueError:
+                        # 崩溃时写了一半的最后一行
+                        continue
+                    if event.op == "complete":
+                        if (task := tasks.get(event.account_id)) and task.time == event.time:
+                            del tasks[event.account_id]
+                    elif event.task is not None:
+                        if event.account_id not in tasks or tasks[event.account_id].time <= event.time:
+                            tasks[event.account_id] = event.task
+        except FileNotFoundError:
+            pass
+        return tasks
+
+    def compact_sync(self, data: bytes) -> None:
+        with open(f"{self.snapshot}.tmp", "wb") as f:
+            append_sync(f, data)
+        os.replace(f"{self.snapshot}.tmp", self.snapshot)
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path, "wb")
+
+    def record(self, op: Literal["schedule", "retry", "complete"], account_id: int, task: BackupTask) -> None:
+        event = BackupJournalEvent(op=op, account_id=account_id, time=task.time, task=None if op == "complete" else task)
+        self.buffer.append(event.model_dump_json().encode() + b"\n")
+
+    async def flush(self) -> None:
+        async with self.lock:
+            if not self.buffer:
+                return
+            data = b"".join(self.buffer)
+            self.lines += len(self.buffer)
+            self.buffer.clear()
+            if self.file is None:
+                self.file = await self.io.run(open, self.path, "ab")
+            await self.io.run(append_sync, self.file, data)
+
+    async def compact(self, tasks: dict[int, BackupTask]) -> None:
+        async with self.lock:
+            data = self.TASKS_ADAPTER.dump_json(tasks)
+            await self.io.run(self.compact_sync, data)
+            self.lines = 0
+
+    async def run(self, tasks: dict[int, BackupTask]) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if self.lines >= max(self.compact_size, len(tasks)):
+                    await self.compact(tasks)
+            except OSError:
+                logger.exception("写入备份任务日志失败")
+
+    async def close(self, tasks: dict[int, BackupTask]) -> None:
+        await self.flush()
+        await self.compact(tasks)
+        if self.file is not None:
+            await self.io.run(self.file.close)
+            self.file = None
+
+
+class RateLimiter:
+    def __init__(self, rate: float | None, burst: float | None = None) -> None:
+        self.rate = rate
+        self.burst = burst or rate or 0
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount: int) -> None:
+        if self.rate is None:
+            return
+        async with self.lock:
+            current_time = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (current_time - self.last) * self.rate)
+            self.last = current_time
+            self.tokens -= amount
+            if self.tokens < 0:
+                await asyncio.sleep(-self.tokens / self.rate)
+
+
 class BackupScheduler:
-    def __init__(self, client: aiohttp.ClientSession, retry_interval: float = 60, retry_4xx: bool = False, **kw: Any) -> None:
+    def __init__(
+        self,
+        client: aiohttp.ClientSession,
+        io: FileIO,
+        retry_interval: float = 60,
+        retry_4xx: bool = False,
+        concurrency: int = 2,
+        rate: int | None = None,
+        journal: BackupJournal | None = None,
+        resolve_server: Callable[[int], Awaitable[str | web.Response]] | None = None,
+        **kw: Any,
+    ) -> None:
         self.tasks: dict[int, BackupTask] = {}
         self.locks: dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
         self.handles: dict[int, asyncio.TimerHandle] = {}
+        # 每个帐号最多排队一次，按先进先出轮流上传
+        self.ready: deque[int] = deque()
+        self.ready_since: dict[int, float] = {}
+        self.ready_event = asyncio.Event()
+        self.active = 0
+        self.wait_times: deque[float] = deque(maxlen=100)
+        self.upload_times: deque[float] = deque(maxlen=100)
+        self.workers: list[asyncio.Task[None]] = []
+        self.limiter = RateLimiter(rate)
+        self.journal = journal
         client.cookie_jar.update_cookies({"gd": "1"})
         self.client = client
+        self.io = io
         self.retry_interval = retry_interval
         self.retry_4xx = retry_4xx
+        self.concurrency = concurrency
+        self.resolve_server = resolve_server
         self.kw = kw
 
-    def schedule(self, account_id: int, task: BackupTask, delay: float = 0) -> None:
-        def do_scheduled_upload() -> None:
-            del self.handles[account_id]
-            asyncio.create_task(self.do_upload(account_id, self.tasks.pop(account_id)))
+    def start(self) -> None:
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(self.concurrency)]
 
+    async def close(self) -> None:
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        for handle in self.handles.values():
+            handle.cancel()
+
+    def schedule(self, account_id: int, task: BackupTask, delay: float = 0, op: Literal["schedule", "retry"] | None = "schedule") -> None:
         if account_id in self.tasks and task.time < self.tasks[account_id].time:
             return
         self.tasks[account_id] = task
+        if self.journal and op:
+            self.journal.record(op, account_id, task)
+        if account_id in self.ready_since:
+            return
 
         loop = asyncio.get_running_loop()
         if account_id in self.handles and (handle := self.handles[account_id]).when() - loop.time() > delay:
             handle.cancel()
             del self.handles[account_id]
         if account_id not in self.handles:
-            self.handles[account_id] = loop.call_later(delay, do_scheduled_upload)
+            if delay <= 0:
+                self.enqueue(account_id)
+            else:
+                self.handles[account_id] = loop.call_later(delay, self.enqueue, account_id)
+
+    def enqueue(self, account_id: int) -> None:
+        self.handles.pop(account_id, None)
+        if account_id in self.ready_since or account_id not in self.tasks:
+            return
+        self.ready_since[account_id] = time.monotonic()
+        self.ready.append(account_id)
+        self.ready_event.set()
+
+    async def worker(self) -> None:
+        while True:
+            while not self.ready:
+                self.ready_event.clear()
+                await self.ready_event.wait()
+            account_id = self.ready.popleft()
+            self.wait_times.append(time.monotonic() - self.ready_since.pop(account_id))
+            task = self.tasks[account_id]
+            self.active += 1
+            start_time = time.monotonic()
+            try:
+                await self.do_upload(account_id, task)
+            except Exception:
+                logger.exception(f"备份 {account_id} 的数据时出错")
+            finally:
+                self.active -= 1
+                self.upload_times.append(time.monotonic() - start_time)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "queue_depth": len(self.ready),
+            "delayed": len(self.handles),
+            "active": self.active,
+            "wait_avg": sum(self.wait_times) / len(self.wait_times) if self.wait_times else 0,
+            "wait_max": max(self.wait_times, default=0),
+            "upload_avg": sum(self.upload_times) / len(self.upload_times) if self.upload_times else 0,
+        }
+
+    async def upload_body(self, prefix: bytes, f: Any, size: int) -> AsyncGenerator[bytes, None]:
+        await self.limiter.acquire(len(prefix))
+        yield prefix
+        remaining = size
+        while remaining > 0 and (chunk := await self.io.run(f.read, min(READ_CHUNK_SIZE, remaining))):
+            remaining -= len(chunk)
+            data = quote_plus(chunk).encode()
+            await self.limiter.acquire(len(data))
+            yield data
+
+    def complete(self, account_id: int, task: BackupTask) -> None:
+        if self.tasks.get(account_id) is task:
+            del self.tasks[account_id]
+            if self.journal:
+                self.journal.record("complete", account_id, task)
+
+    def retry(self, account_id: int, task: BackupTask, reason: str) -> None:
+        if task.retry_left != 0:
+            logger.warning(f"备份 {account_id} 的数据失败，{reason}，剩余 {task.retry_left} 次重试，下一次在 {self.retry_interval} 秒后")
+            task.retry_left = None if task.retry_left is None else task.retry_left - 1
+            self.schedule(account_id, task, self.retry_interval, "retry")
+        else:
+            logger.warning(f"备份 {account_id} 的数据失败，{reason}")
+            self.complete(account_id, task)
 
     async def do_upload(self, account_id: int, task: BackupTask) -> None:
         async with self.locks[account_id]:
-            logger.info(f"正在备份 {account_id} 的数据到服务器 {task.server}")
-            with open(f"accounts/{account_id}/CCGameManager.xml.gz", "rb") as f:
-                ccgamemanager = base64.urlsafe_b64encode(f.read()).decode()
-            with open(f"accounts/{account_id}/CCLocalLevels.xml.gz", "rb") as f:
-                cclocallevels = base64.urlsafe_b64encode(f.read()).decode()
-            form = {"accountID": account_id, "saveData": f"{ccgamemanager};{cclocallevels}", **task.token}
-            async with self.client.post(f"{task.server_str}/database/accounts/backupGJAccountNew.php", data=form, **self.kw) as response:
-                result = await response.read()
-                if response.ok and result == b"1":
-                    logger.success(f"备份 {account_id} 的数据成功")
+            if task.server is None:
+                if self.resolve_server is None:
+                    logger.warning(f"无法获取 {account_id} 的备份服务器，跳过备份")
+                    self.complete(account_id, task)
                     return
-                if task.retry_left != 0 and (self.retry_4xx or not 400 <= response.status <= 499):
-                    logger.warning(f"备份 {account_id} 的数据失败，响应: {result!r}，剩余 {task.retry_left} 次重试，下一次在 {self.retry_interval} 秒后")
-                    task.retry_left = None if task.retry_left is None else task.retry_left - 1
-                    self.schedule(account_id, task, self.retry_interval)
-                else:
-                    logger.warning(f"备份 {account_id} 的数据失败，响应: {result!r}")
+                try:
+                    data = await self.resolve_server(account_id)
+                except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError) as e:
+                    self.retry(account_id, task, f"获取备份服务器失败: {e!r}")
+                    return
+                if isinstance(data, web.Response):
+                    self.retry(account_id, task, f"获取备份服务器失败，响应: {data.body!r}")
+                    return
+                try:
+                    task.server = HttpUrl(data)
+                except ValueError:
+                    logger.warning(f"{account_id} 的备份服务器无效: {data!r}")
+                    self.complete(account_id, task)
+                    return
+            logger.info(f"正在备份 {account_id} 的数据到服务器 {task.server}")
+            try:
+                f, size, encoded_size = await self.io.run(open_save_data, account_id)
+            except FileNotFoundError:
+                logger.warning(f"{account_id} 的本地存档不存在，跳过备份")
+                self.complete(account_id, task)
+                return
+            except OSError as e:
+                self.retry(account_id, task, f"读取存档失败: {e!r}")
+                return
+            try:
+                prefix = f"{urlencode({'accountID': account_id, **task.token})}&saveData=".encode()
+                headers = {"Content-Type": "application/x-www-form-urlencoded", "Content-Length": str(len(prefix) + encoded_size)}
+                async with self.client.post(f"{task.server_str}/database/accounts/backupGJAccountNew.php", data=self.upload_body(prefix, f, size), headers=headers, **self.kw) as response:
+                    result = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.retry(account_id, task, f"错误: {e!r}")
+                return
+            finally:
+                await self.io.run(f.close)
+            if response.ok and result == b"1":
+                logger.success(f"备份 {account_id} 的数据成功")
+                self.complete(account_id, task)
+            elif self.retry_4xx or not 400 <= response.status <= 499:
+                self.retry(account_id, task, f"响应: {result!r}")
+            else:
+                logger.warning(f"备份 {account_id} 的数据失败，响应: {result!r}")
+                self.complete(account_id, task)
 
 
 async def stream_response(request: web.BaseRequest, response: aiohttp.ClientResponse) -> web.StreamResponse:
@@ -220,6 +1522,10 @@ async def stream_response(request: web.BaseRequest, response: aiohttp.ClientResp
         headers["Content-Encoding"] = response.headers["Content-Encoding"]
     if "Content-Length" in response.headers:
         headers["Content-Length"] = response.headers["Content-Length"]
+    if "Content-Range" in response.headers:
+        headers["Content-Range"] = response.headers["Content-Range"]
+    if "Accept-Ranges" in response.headers:
+        headers["Accept-Ranges"] = response.headers["Accept-Ranges"]
     stream = web.StreamResponse(status=response.status, headers=headers)
     await stream.prepare(request)
     async for data in response.content.iter_any():
@@ -228,6 +1534,36 @@ async def stream_response(request: web.BaseRequest, response: aiohttp.ClientResp
     return stream
 
 
+def parse_range(request: web.BaseRequest) -> slice | None:
+    try:
+        http_range = request.http_range
+    except ValueError:
+        # 多个范围或格式错误时忽略 Range，返回完整内容
+        return None
+    if http_range.start is None and http_range.stop is None:
+        return None
+    return http_range
+
+
+def resolve_range(request: web.BaseRequest, total: int) -> tuple[int, int] | None:
+    if (http_range := parse_range(request)) is None:
+        return None
+    start, stop = http_range.start, http_range.stop
+    if start is None:
+        start = 0
+    elif start < 0:
+        start = max(total + start, 0)
+    stop = total if stop is None else min(stop, total)
+    if start >= total or start >= stop:
+        raise web.HTTPRequestRangeNotSatisfiable(headers={"Content-Range": f"bytes */{total}"})
+    return start, stop
+
+
+async def get_backup_server(api: "ApiManager", account_id: int) -> str | web.Response:
+    async with api.getAccountURL(data={"accountID": account_id, "type": 1, "secret": "Wmfd2893gb7"}) as response:
+        return await api_read(response)
+
+
 async def api_read(response: aiohttp.ClientResponse) -> str | web.Response:
     text = await response.text(errors="replace")
     if not text or not response.ok:
@@ -239,13 +1575,275 @@ async def api_read(response: aiohttp.ClientResponse) -> str | web.Response:
     return text
 
 
+class ConnectionPool:
+    def __init__(self, name: str, config: ConnectionPoolConfig) -> None:
+        self.name = name
+        self.limit = config.limit
+        self.in_flight = 0
+        self.queued = 0
+        self.created = 0
+        self.reused = 0
+        self.queue_times: deque[float] = deque(maxlen=100)
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(self.on_request_start)
+        trace.on_request_end.append(self.on_request_end)
+        trace.on_request_exception.append(self.on_request_end)
+        trace.on_connection_queued_start.append(self.on_queued_start)
+        trace.on_connection_queued_end.append(self.on_queued_end)
+        trace.on_connection_create_end.append(self.on_create_end)
+        trace.on_connection_reuseconn.append(self.on_reuseconn)
+        if config.keepalive_timeout:
+            keepalive: dict[str, Any] = {"keepalive_timeout": config.keepalive_timeout}
+        else:
+            keepalive = {"force_close": True}
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=config.limit,
+                limit_per_host=config.limit_per_host,
+                use_dns_cache=config.dns_cache_ttl != 0,
+                ttl_dns_cache=config.dns_cache_ttl,
+                **keepalive,
+            ),
+            timeout=aiohttp.ClientTimeout(total=config.total_timeout, sock_connect=config.connect_timeout, sock_read=config.read_timeout),
+            trace_configs=[trace],
+        )
+
+    async def on_request_start(self, session: aiohttp.ClientSession, ctx: Any, params: Any) -> None:
+        self.in_flight += 1
+
+    async def on_request_end(self, session: aiohttp.ClientSession, ctx: Any, params: Any) -> None:
+        self.in_flight -= 1
+
+    async def on_queued_start(self, session: aiohttp.ClientSession, ctx: Any, params: Any) -> None:
+        self.queued += 1
+        ctx.queued_at = time.monotonic()
+
+    async def on_queued_end(self, session: aiohttp.ClientSession, ctx: Any, params: Any) -> None:
+        self.queued -= 1
+        self.queue_times.append(time.monotonic() - ctx.queued_at)
+
+    async def on_create_end(self, session: aiohttp.ClientSession, ctx: Any, params: Any) -> None:
+        self.created += 1
+
+    async def on_reuseconn(self, session: aiohttp.ClientSession, ctx: Any, params: Any) -> None:
+        self.reused += 1
+
+    def stats(self) -> dict[str, Any]:
+        # in_flight 只统计还没收到响应头的请求，串流中的响应不计入
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "queue_avg": sum(self.queue_times) / len(self.queue_times) if self.queue_times else 0,
+            "queue_max": max(self.queue_times, default=0),
+            "created": self.created,
+            "reused": self.reused,
+        }
+
+
+# 不继承 aiohttp.ClientError，熔断时不应被当作普通的请求失败而重试
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, threshold: int, timeout: float) -> None:
+        self.name = name
+        self.threshold = threshold
+        self.timeout = timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        # 由健康检查设置，期间不放行任何请求
+        self.down = False
+        self.succeeded_at: float | None = None
+
+    @property
+    def state(self) -> Literal["closed", "open", "half-open", "down"]:
+        if self.down:
+            return "down"
+        if self.opened_at is None:
+            return "closed"
+        return "open" if time.monotonic() - self.opened_at < self.timeout else "half-open"
+
+    def allow(self) -> bool:
+        if self.down:
+            return False
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at < self.timeout:
+            return False
+        # 半开状态每隔 timeout 秒只放行一个请求试探
+        self.opened_at = time.monotonic()
+        return True
+
+    def check(self) -> None:
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} 暂时不可用")
+
+    def record(self, status: int) -> None:
+        if status >= 500:
+            self.failure()
+        else:
+            self.success()
+
+    def success(self) -> None:
+        if self.opened_at is not None:
+            logger.info(f"{self.name} 已恢复")
+        self.failures = 0
+        self.opened_at = None
+        self.succeeded_at = time.monotonic()
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.threshold and self.failures >= self.threshold and self.opened_at is None:
+            logger.warning(f"{self.name} 连续失败 {self.failures} 次，{self.timeout} 秒内不再请求")
+            self.opened_at = time.monotonic()
+
+
+class HealthProbe:
+    def __init__(self, name: str, session: aiohttp.ClientSession, url: str, breaker: CircuitBreaker, expiry: ExpiryScheduler, interval: float, timeout: float, threshold: int, **kw: Any) -> None:
+        self.name = name
+        self.session = session
+        self.url = url
+        self.breaker = breaker
+        self.expiry = expiry
+        self.interval = interval
+        self.timeout = timeout
+        self.threshold = threshold
+        self.up = True
+        self.failures = 0
+        self.changed_at = time.time()
+        self.latency: float | None = None
+        self.kw = kw
+        UPSTREAM_UP.set(1, name)
+
+    async def probe(self) -> bool:
+        start_time = time.monotonic()
+        try:
+            async with self.session.get(self.url, timeout=aiohttp.ClientTimeout(total=self.timeout), **self.kw) as response:
+                await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.debug(f"{self.name} 健康检查失败: {e!r}")
+            return False
+        self.latency = time.monotonic() - start_time
+        # 能收到响应就说明网络可达，5xx 说明服务器本身出了问题
+        return response.status < 500
+
+    def set(self, up: bool) -> None:
+        self.up = up
+        self.changed_at = time.time()
+        self.breaker.down = not up
+        self.expiry.paused = not up
+        UPSTREAM_UP.set(int(up), self.name)
+        if up:
+            logger.success(f"{self.name} 已恢复，退出降级模式")
+        else:
+            logger.warning(f"{self.name} 连续 {self.failures} 次健康检查失败，进入降级模式，只使用本地缓存")
+
+    async def run(self) -> None:
+        while True:
+            if await self.probe():
+                self.failures = 0
+                if not self.up:
+                    self.set(True)
+            else:
+                self.failures += 1
+                # 健康检查失败期间实际请求仍然成功时，说明是检查本身的问题，不进入降级模式
+                succeeded_at = self.breaker.succeeded_at
+                if succeeded_at is not None and time.monotonic() - succeeded_at < self.interval * self.threshold:
+                    logger.debug(f"{self.name} 健康检查失败，但最近的请求成功，不进入降级模式")
+                elif self.up and self.failures >= self.threshold:
+                    self.set(False)
+            await asyncio.sleep(self.interval)
+
+    def stats(self) -> dict[str, Any]:
+        return {"up": self.up, "failures": self.failures, "changed_at": self.changed_at, "latency": self.latency}
+
+
+class RetryPolicy:
+    def __init__(self, breaker: CircuitBreaker, count: int | None, retry_4xx: bool, backoff: float, backoff_max: float, jitter: float, deadline: float | None) -> None:
+        self.breaker = breaker
+        self.count = count
+        self.retry_4xx = retry_4xx
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.deadline = deadline
+
+    def retryable(self, status: int) -> bool:
+        return status >= 500 or (self.retry_4xx and 400 <= status <= 499)
+
+    def start(self) -> "RetryState":
+        return RetryState(self)
+
+    async def request(self, send: Callable[[], Awaitable[aiohttp.ClientResponse]]) -> aiohttp.ClientResponse:
+        state = self.start()
+        while (response := await state.attempt(send)) is None:
+            pass
+        return response
+
+
+class RetryState:
+    def __init__(self, policy: RetryPolicy) -> None:
+        self.policy = policy
+        self.attempts = 0
+        self.deadline = None if policy.deadline is None else time.monotonic() + policy.deadline
+
+    @property
+    def retry_left(self) -> int | None:
+        return None if self.policy.count is None else self.policy.count - self.attempts
+
+    def delay(self) -> float | None:
+        policy = self.policy
+        if policy.count is not None and self.attempts >= policy.count:
+            return None
+        delay = min(policy.backoff_max, policy.backoff * 2 ** self.attempts) * (1 - policy.jitter * random.random())
+        if self.deadline is not None and time.monotonic() + delay > self.deadline:
+            return None
+        self.attempts += 1
+        return delay
+
+    async def attempt(self, send: Callable[[], Awaitable[aiohttp.ClientResponse]]) -> aiohttp.ClientResponse | None:
+        # 返回 None 时表示已经等待完退避时间，需要再试一次
+        breaker = self.policy.breaker
+        breaker.check()
+        try:
+            with span(f"{breaker.name}.attempt", attempt=self.attempts) as attrs:
+                response = await send()
+                attrs["status"] = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            breaker.failure()
+            if (delay := self.delay()) is None:
+                raise
+            logger.warning(f"请求 {breaker.name} 失败: {e!r} 剩余 {self.retry_left} 次重试")
+            await asyncio.sleep(delay)
+            return None
+        breaker.record(response.status)
+        if response.ok or not self.policy.retryable(response.status) or (delay := self.delay()) is None:
+            logger.log("DEBUG" if response.ok else "WARNING", f"{response.status} {response.method} {response.url}")
+            return response
+        logger.warning(f"{response.status} {response.method} {response.url} 剩余 {self.retry_left} 次重试")
+        await response.__aexit__(None, None, None)
+        await asyncio.sleep(delay)
+        return None
+
+
+def quantile(values: Iterable[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0
+
+
+def close_response(task: asyncio.Task[aiohttp.ClientResponse | None]) -> None:
+    if not task.cancelled() and task.exception() is None and (response := task.result()) is not None:
+        response.close()
+
+
 class ApiManager:
-    def __init__(self, client: aiohttp.ClientSession, server: str, retry_count: int | None = None, retry_4xx: bool = False, *, headers: LooseHeaders | None = None, **kw: Any) -> None:
+    def __init__(self, client: aiohttp.ClientSession, server: str, retry: RetryPolicy, *, headers: LooseHeaders | None = None, **kw: Any) -> None:
         client.cookie_jar.update_cookies({"gd": "1"})
         self.client = client
         self.server = server
-        self.retry_count = retry_count
-        self.retry_4xx = retry_4xx
+        self.retry = retry
         self.headers = headers
         if "skip_auto_headers" not in kw:
             kw["skip_auto_headers"] = ["User-Agent"]
@@ -292,21 +1890,243 @@ class ApiContextManager(AsyncContextManager, Awaitable[aiohttp.ClientResponse]):
         kw.update(self.kw)
         if self.headers:
             headers.update(self.headers)
-        retry_left = self.manager.retry_count
-        while True:
-            response = await self.manager.client.post(f"{self.manager.server}/{self.api}.php", headers=headers, **kw)
-            if response.ok or (retry_left is not None and retry_left <= 0) or (400 <= response.status <= 499 and not self.manager.retry_4xx):
-                logger.log("DEBUG" if response.ok else "WARNING", f"{response.status} {response.method} {response.url}")
-                self._resp = response
-                return response
-            logger.warning(f"{response.status} {response.method} {response.url} 剩余 {retry_left} 次重试")
-            retry_left = None if retry_left is None else retry_left - 1
-            await response.__aexit__(None, None, None)
+        label = self.api if self.api in KNOWN_APIS else "other"
+        start_time = time.monotonic()
+        with span(f"api.{self.api}") as attrs:
+            try:
+                self._resp = await self.manager.retry.request(lambda: self.manager.client.post(f"{self.manager.server}/{self.api}.php", headers=headers, **kw))
+            except Exception:
+                UPSTREAM_RESPONSES.inc(label, "error")
+                raise
+            finally:
+                UPSTREAM_LATENCY.observe(time.monotonic() - start_time, label)
+            attrs["status"] = self._resp.status
+        UPSTREAM_RESPONSES.inc(label, str(self._resp.status))
+        return self._resp
 
     async def __aexit__(self, exc_type: type[BaseException] | None, exc: BaseException | None, tb: TracebackType | None) -> None:
         await self._resp.__aexit__(exc_type, exc, tb)
 
 
+class CachedResponse(TimedItem):
+    status: int
+    body: bytes
+
+    def response(self) -> web.Response:
+        return web.Response(status=self.status, body=self.body)
+
+
+class ResponseCache:
+    def __init__(self, rules: dict[str, ResponseCacheRule], max_bytes: int, ignored_fields: set[str]) -> None:
+        self.rules = rules
+        self.ignored_fields = ignored_fields
+        self.memory: LruCache[str, CachedResponse] = LruCache(None, max_bytes)
+        self.refreshing: set[str] = set()
+        self.pending: set[asyncio.Task[Any]] = set()
+        self.flight: SingleFlight[str, CachedResponse] = SingleFlight()
+
+    def cacheable(self, api: str) -> bool:
+        return api in self.rules
+
+    async def key(self, request: web.BaseRequest, api: str, vary: str = "") -> str:
+        # 不同用户的凭据不影响这些接口的结果
+        form = await request.post()
+        fields = sorted((k, v) for k, v in form.items() if k not in self.ignored_fields and isinstance(v, str))
+        key = f"{api}?{urlencode(fields)}#{vary}"
+        rule = self.rules[api]
+        if rule.per_viewer or any(form.get(k) in values for k, values in rule.per_viewer_values.items()):
+            # 键里只保留凭据的哈希，免得出现在日志中
+            credentials = urlencode(sorted((k, v) for k, v in form.items() if k in self.ignored_fields and isinstance(v, str)))
+            key += f"@{hashlib.sha256(credentials.encode()).hexdigest()[:16]}"
+        return key
+
+    async def handle(self, request: web.BaseRequest, api: str, fetch: Callable[[], Awaitable[CachedResponse]], vary: str = "") -> web.Response:
+        rule = self.rules[api]
+        key = await self.key(request, api, vary)
+        if (cached := self.memory.get(key)) is not None and (age := time.time() - cached.time) < rule.ttl + rule.stale_while_revalidate:
+            stale = age >= rule.ttl
+            CACHE_REQUESTS.inc("response", "stale" if stale else "hit")
+            if stale and key not in self.refreshing:
+                self.refreshing.add(key)
+                task = asyncio.create_task(self.refresh(key, rule, fetch))
+                self.pending.add(task)
+                task.add_done_callback(self.pending.discard)
+            return cached.response()
+        CACHE_REQUESTS.inc("response", "miss")
+        try:
+            result = await self.flight.do(key, lambda: self.fetch(key, rule, fetch))
+        except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError) as e:
+            if cached is None:
+                raise
+            logger.warning(f"请求 {api} 失败，返回旧的缓存: {e!r}")
+            result = cached
+        else:
+            # 更旧的缓存只在上游出错时使用
+            if result.status >= 500 and cached is not None:
+                logger.warning(f"请求 {api} 失败，返回旧的缓存: {result.status}")
+                result = cached
+        return result.response()
+
+    async def fetch(self, key: str, rule: ResponseCacheRule, fetch: Callable[[], Awaitable[CachedResponse]]) -> CachedResponse:
+        result = await fetch()
+        # 负数是 GD 的错误码，不缓存
+        if result.status == 200 and result.body and not result.body.startswith(b"-"):
+            self.memory.put(key, result, len(key) + len(result.body), result.time + rule.ttl + rule.stale_while_revalidate + rule.stale_if_error)
+        return result
+
+    async def refresh(self, key: str, rule: ResponseCacheRule, fetch: Callable[[], Awaitable[CachedResponse]]) -> None:
+        try:
+            await self.flight.do(key, lambda: self.fetch(key, rule, fetch))
+        except Exception as e:
+            logger.warning(f"刷新缓存 {key} 失败: {e}")
+        finally:
+            self.refreshing.discard(key)
+
+
+class LevelCacheItem(TimedItem):
+    model_config = ConfigDict(ser_json_bytes="base64", val_json_bytes="base64")
+
+    version: int
+    variant: str
+    data: bytes
+
+    def pack_body(self) -> bytes:
+        variant = self.variant.encode()
+        return struct.pack("<qH", self.version, len(variant)) + variant + self.data
+
+    @classmethod
+    def unpack_body(cls, item_time: float, body: bytes) -> "LevelCacheItem":
+        version, size = struct.unpack_from("<qH", body)
+        start = struct.calcsize("<qH")
+        return cls(time=item_time, version=version, variant=body[start:start + size].decode(), data=body[start + size:])
+
+
+class LevelCache(Expirable):
+    # 缓存里的歌曲链接用占位符代替服务器地址，不同地址访问时可以共用
+    ORIGIN = "GDLOCALORIGIN"
+    VARY_FIELDS = ("gameVersion", "binaryVersion", "extras")
+    # 仅好友可见等关卡的结果与请求者有关，带凭据的请求按凭据的哈希分开缓存
+    VIEWER_FIELDS = ("accountID", "gjp", "gjp2")
+
+    def __init__(self, ttl: float | None, store: MetadataStore[LevelCacheItem], expiry: ExpiryScheduler, io: FileIO, compress_level: int = 6, versions_entries: int = 65536) -> None:
+        self.ttl = ttl
+        self.store = store
+        self.expiry = expiry
+        self.io = io
+        self.compress_level = compress_level
+        # 关卡列表里看到的最新版本号，用于判断缓存是否过期
+        self.versions: LruCache[int, int] = LruCache(versions_entries, versions_entries * 64)
+        self.flight: SingleFlight[tuple[int, str], CachedResponse] = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def level_id(form: Mapping[str, Any]) -> int | None:
+        try:
+            id = int(form["levelID"])
+        except (KeyError, ValueError):
+            return None
+        # 每日、每周等特殊关卡的 ID 是负数，内容会变
+        return id if id > 0 else None
+
+    def variant(self, form: Mapping[str, Any]) -> str:
+        fields = [(k, form[k]) for k in self.VARY_FIELDS if isinstance(form.get(k), str)]
+        if credentials := [(k, form[k]) for k in self.VIEWER_FIELDS if isinstance(form.get(k), str)]:
+            fields.append(("viewer", hashlib.sha256(urlencode(credentials).encode()).hexdigest()[:16]))
+        return urlencode(fields)
+
+    def observe(self, levels: str) -> None:
+        for level in levels.split("|") if levels else []:
+            level = level.split(":")
+            level = {level[i]: level[i + 1] for i in range(0, len(level) - 1, 2)}
+            try:
+                self.versions.put(int(level["1"]), int(level["5"]), 64)
+            except (KeyError, ValueError):
+                continue
+
+    async def load(self, cache: LevelCacheItem) -> CachedResponse:
+        return CachedResponse(time=cache.time, status=200, body=await self.io.run(zlib.decompress, cache.data))
+
+    async def handle(self, id: int, variant: str, fetch: Callable[[], Awaitable[CachedResponse]]) -> CachedResponse:
+        with span("level_cache.get", id=id) as attrs:
+            cache = await self.io.run(self.store.load, id)
+            if cache is not None and cache.variant != variant:
+                cache = None
+            if cache is not None and (self.ttl is None or time.time() - cache.time < self.ttl):
+                known = self.versions.get(id)
+                if known is None or known == cache.version:
+                    self.hits += 1
+                    CACHE_REQUESTS.inc("level", "hit")
+                    attrs["result"] = "hit"
+                    return await self.load(cache)
+                logger.info(f"关卡 {id} 已更新到版本 {known}，重新获取中")
+            self.misses += 1
+            CACHE_REQUESTS.inc("level", "miss")
+            attrs["result"] = "miss"
+            try:
+                result = await self.flight.do((id, variant), lambda: self.fetch(id, variant, fetch))
+            except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError) as e:
+                if cache is None:
+                    raise
+                logger.warning(f"获取关卡 {id} 失败，返回旧的缓存: {e!r}")
+                return await self.load(cache)
+            if result.status >= 500 and cache is not None:
+                logger.warning(f"获取关卡 {id} 失败，返回旧的缓存: {result.status}")
+                return await self.load(cache)
+            return result
+
+    async def fetch(self, id: int, variant: str, fetch: Callable[[], Awaitable[CachedResponse]]) -> CachedResponse:
+        result = await fetch()
+        if result.status != 200 or not result.body or result.body.startswith(b"-"):
+            return result
+        level = result.body.split(b"#", 1)[0].decode(errors="replace").split(":")
+        level = {level[i]: level[i + 1] for i in range(0, len(level) - 1, 2)}
+        try:
+            version = int(level["5"])
+        except (KeyError, ValueError):
+            return result
+        data = await self.io.run(zlib.compress, result.body, self.compress_level)
+        with span("level_cache.insert", id=id, size=len(data)):
+            await self.io.run(self.store.save, id, LevelCacheItem(time=result.time, version=version, variant=variant, data=data))
+        self.versions.put(id, version, 64)
+        logger.info(f"已缓存关卡 {id}（版本 {version}，压缩后 {len(data)} 字节）")
+        if self.ttl is not None:
+            self.schedule_delete(id, self.ttl)
+        return result
+
+    @classmethod
+    def localize(cls, body: bytes, origin: str) -> bytes:
+        # 只替换音乐列表（第 5 段），关卡数据本身可能碰巧含有占位符
+        start = -1
+        for _ in range(4):
+            if (start := body.find(b"#", start + 1)) == -1:
+                return body
+        if (end := body.find(b"#", start + 1)) == -1:
+            end = len(body)
+        return body[:start + 1] + body[start + 1:end].replace(cls.ORIGIN.encode(), encodeuri(origin, safe="").encode()) + body[end:]
+
+    def schedule_delete(self, id: int, delay: float) -> None:
+        self.expiry.schedule(self, id, delay)
+
+    async def expire(self, ids: list[int]) -> None:
+        assert self.ttl is not None
+        ids = await self.io.run(self.store.remove_expired, ids, time.time() - self.ttl)
+        if ids:
+            CACHE_EXPIRED.inc("level", amount=len(ids))
+            logger.info(f"已删除 {len(ids)} 个关卡的缓存")
+
+    async def clean(self) -> None:
+        if self.ttl is None:
+            return
+        current_time = time.time()
+        for id, item_time in await self.io.run(list, self.store.scan()):
+            self.schedule_delete(id, self.ttl - (current_time - item_time))
+
+    def stats(self) -> dict[str, Any]:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_ratio": self.hits / total if total else None, "known_versions": len(self.versions.entries)}
+
+
 def load_song_info(info: str) -> dict[int, str]:
     data = info.split("~|~")
     data = {int(data[i]): data[i + 1] for i in range(0, len(data), 2)}
@@ -319,26 +2139,82 @@ def dump_song_info(data: dict[int, str]) -> str:
     return "~|~".join(f"{k}~|~{encodeuri(v, safe='') if k == 10 else v}" for k, v in data.items())
 
 
-class SongInfoCacheItem(BaseModel):
-    time: float = Field(default_factory=time.time)
-    data: dict[int, str] | int
+SONG_INFO_FIELD = struct.Struct("<HI")
 
 
-class SongInfoCache:
-    def __init__(self, api: ApiCaller, ttl: float | None) -> None:
+class SongInfoCacheItem(TimedItem):
+    data: dict[int, str] | int
+
+    @property
+    def size(self) -> int:
+        if isinstance(self.data, int):
+            return 64
+        return 64 + sum(len(v) + 16 for v in self.data.values())
+
+    # 错误码为 i 加上 int64，元数据为 d 加上若干个 (uint16 键, uint32 长度, 值)
+    def pack_body(self) -> bytes:
+        if isinstance(self.data, int):
+            return b"i" + struct.pack("<q", self.data)
+        parts = [b"d"]
+        for key, value in self.data.items():
+            encoded = value.encode()
+            parts.append(SONG_INFO_FIELD.pack(key, len(encoded)))
+            parts.append(encoded)
+        return b"".join(parts)
+
+    @classmethod
+    def unpack_body(cls, item_time: float, body: bytes) -> "SongInfoCacheItem":
+        if body[:1] == b"i":
+            return cls(time=item_time, data=struct.unpack_from("<q", body, 1)[0])
+        data = {}
+        pos = 1
+        while pos < len(body):
+            key, size = SONG_INFO_FIELD.unpack_from(body, pos)
+            pos += SONG_INFO_FIELD.size
+            data[key] = body[pos:pos + size].decode()
+            pos += size
+        return cls(time=item_time, data=data)
+
+
+class SongInfoCache(Expirable):
+    def __init__(self, api: ApiCaller, ttl: float | None, store: MetadataStore[SongInfoCacheItem], expiry: ExpiryScheduler, io: FileIO, memory_entries: int = 4096, memory_bytes: int = 4 * 1024 * 1024) -> None:
         self.api = api
         self.ttl = ttl
-        self.delete_tokens: dict[int, asyncio.TimerHandle] = {}
+        self.store = store
+        self.expiry = expiry
+        self.io = io
+        self.memory: LruCache[int, SongInfoCacheItem] = LruCache(memory_entries, memory_bytes)
+        self.flight: SingleFlight[int, dict[int, str] | int] = SingleFlight()
+
+    def remember(self, id: int, cache: SongInfoCacheItem) -> None:
+        self.memory.put(id, cache, cache.size, None if self.ttl is None else cache.time + self.ttl)
 
     async def get(self, id: int) -> dict[int, str] | int:
-        try:
-            with open(f"song_infos/{id}.json", "r") as f:
-                cache = SongInfoCacheItem.model_validate(json.load(f))
-            if self.ttl is None or time.time() - cache.time < self.ttl:
-                return cache.data
-            logger.info(f"歌曲 {id} 的元数据缓存已过期，重新获取中")
-        except FileNotFoundError:
-            pass
+        with span("song_info.get", id=id) as attrs:
+            # 调用方会修改返回的 dict，所以需要复制一份
+            if (cache := self.memory.get(id)) is not None:
+                CACHE_REQUESTS.inc("song_info", "hit")
+                attrs["result"] = "memory"
+                return cache.data if isinstance(cache.data, int) else dict(cache.data)
+            if (cache := await self.io.run(self.store.load, id)) is not None:
+                if self.ttl is None or time.time() - cache.time < self.ttl:
+                    CACHE_REQUESTS.inc("song_info", "hit")
+                    attrs["result"] = "store"
+                    self.remember(id, cache)
+                    return cache.data if isinstance(cache.data, int) else dict(cache.data)
+                logger.info(f"歌曲 {id} 的元数据缓存已过期，重新获取中")
+            CACHE_REQUESTS.inc("song_info", "miss")
+            attrs["result"] = "miss"
+            try:
+                info = await self.flight.do(id, lambda: self.fetch(id))
+            except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError) as e:
+                if cache is None:
+                    raise
+                logger.warning(f"获取歌曲 {id} 的元数据失败，使用过期的缓存: {e!r}")
+                info = cache.data
+            return info if isinstance(info, int) else dict(info)
+
+    async def fetch(self, id: int) -> dict[int, str] | int:
         async with self.api(data={"songID": id, "secret": "Wmfd2893gb7"}) as response:
             info = await response.text(errors="replace")
             if not response.ok or not info:
@@ -350,39 +2226,36 @@ class SongInfoCache:
                 info = int(info)
             except ValueError:
                 info = load_song_info(info)
-        self.insert(id, info)
+        await self.insert(id, info)
         return info
 
-    def insert(self, id: int, info: dict[int, str] | int) -> None:
-        os.makedirs("song_infos", exist_ok=True)
-        with open(f"song_infos/{id}.json", "w") as f:
-            logger.info(f"已创建歌曲 {id} 的元数据缓存")
-            pydantic_dump(SongInfoCacheItem(data=info), f)
-            if self.ttl is not None:
-                self.schedule_delete(id, self.ttl)
+    async def insert(self, id: int, info: dict[int, str] | int) -> None:
+        cache = SongInfoCacheItem(data=info if isinstance(info, int) else dict(info))
+        self.remember(id, cache)
+        with span("song_info.insert", id=id):
+            await self.io.run(self.store.save, id, cache)
+        logger.info(f"已创建歌曲 {id} 的元数据缓存")
+        if self.ttl is not None:
+            self.schedule_delete(id, self.ttl)
 
     def schedule_delete(self, id: int, delay: float) -> None:
-        def do_delete() -> None:
-            logger.info(f"已删除歌曲 {id} 的元数据缓存")
-            os.remove(f"song_infos/{id}.json")
-            self.delete_tokens.pop(id, None)
-
-        if token := self.delete_tokens.pop(id, None):
-            token.cancel()
-        if delay <= 0:
-            do_delete()
-        else:
-            self.delete_tokens[id] = asyncio.get_running_loop().call_later(delay, do_delete)
-
-    def clean(self) -> None:
+        self.expiry.schedule(self, id, delay)
+
+    async def expire(self, ids: list[int]) -> None:
+        assert self.ttl is not None
+        for id in ids:
+            self.memory.pop(id)
+        ids = await self.io.run(self.store.remove_expired, ids, time.time() - self.ttl)
+        if ids:
+            CACHE_EXPIRED.inc("song_info", amount=len(ids))
+            logger.info(f"已删除 {len(ids)} 首歌曲的元数据缓存")
+
+    async def clean(self) -> None:
         if self.ttl is None:
             return
         current_time = time.time()
-        for file in try_scandir("song_infos"):
-            with open(file.path) as f:
-                cache = SongInfoCacheItem.model_validate(json.load(f))
-                id = int(file.name.removesuffix(".json"))
-                self.schedule_delete(id, self.ttl - (current_time - cache.time))
+        for id, item_time in await self.io.run(list, self.store.scan()):
+            self.schedule_delete(id, self.ttl - (current_time - item_time))
 
 
 class AssetsServer:
@@ -396,27 +2269,28 @@ class AssetsServerCacheItem(BaseModel):
 
 
 class AssetsServerCache(AssetsServer):
-    def __init__(self, api: ApiCaller, ttl: float | None = 600) -> None:
+    def __init__(self, api: ApiCaller, io: FileIO, ttl: float | None = 600) -> None:
         self.api = api
+        self.io = io
         self.ttl = ttl
-        self.lock = asyncio.Lock()
+        self.flight: SingleFlight[None, str] = SingleFlight()
 
     async def __call__(self) -> str:
-        async with self.lock:
-            try:
-                with open("assets_server.json", "r") as f:
-                    cache = AssetsServerCacheItem.model_validate(json.load(f))
-                if self.ttl is None or time.time() - cache.time < self.ttl:
-                    return cache.cdn
-            except FileNotFoundError:
-                pass
-            async with self.api() as response:
-                cdn = await api_read(response)
-            if isinstance(cdn, web.Response):
-                return ""
-            with open("assets_server.json", "w") as f:
-                pydantic_dump(AssetsServerCacheItem(cdn=cdn), f)
-            return cdn
+        return await self.flight.do(None, self.load)
+
+    async def load(self) -> str:
+        try:
+            cache = AssetsServerCacheItem.model_validate_json(await self.io.read_text("assets_server.json"))
+            if self.ttl is None or time.time() - cache.time < self.ttl:
+                return cache.cdn
+        except FileNotFoundError:
+            pass
+        async with self.api() as response:
+            cdn = await api_read(response)
+        if isinstance(cdn, web.Response):
+            return ""
+        await self.io.write("assets_server.json", AssetsServerCacheItem(cdn=cdn).model_dump_json())
+        return cdn
 
 
 class AssetsServerStatic(AssetsServer):
@@ -432,151 +2306,577 @@ class PrefetchError(BaseModel):
     body: str
 
 
-class PrefetchCacheItem(BaseModel):
-    time: float = Field(default_factory=time.time)
+class PrefetchCacheItem(TimedItem):
     error: PrefetchError | None = None
 
+    # 下载成功时没有内容，失败时为 uint16 状态码加上响应内容
+    def pack_body(self) -> bytes:
+        if self.error is None:
+            return b""
+        return struct.pack("<H", self.error.status) + self.error.body.encode()
+
+    @classmethod
+    def unpack_body(cls, item_time: float, body: bytes) -> "PrefetchCacheItem":
+        if not body:
+            return cls(time=item_time, error=None)
+        error = PrefetchError(status=struct.unpack_from("<H", body)[0], body=body[2:].decode(errors="replace"))
+        return cls(time=item_time, error=error)
+
+
+def write_chunk(f: Any, data: bytes) -> None:
+    f.write(data)
+    f.flush()
+
+
+def read_chunk(f: Any, pos: int, size: int) -> bytes:
+    f.seek(pos)
+    return f.read(size)
+
+
+class PrefetchPriority(IntEnum):
+    STREAM = 0
+    ENSURE = 1
+    PREDICT = 2
+
+
+class PrefetchRequest(BaseModel):
+    priority: PrefetchPriority
+
+
+class PrefetchTouch(BaseModel):
+    time: float = Field(default_factory=time.time)
+
+
+class PrefetchTicket:
+    def __init__(self, priority: PrefetchPriority) -> None:
+        self.priority = priority
+        self.future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        self.queued_at = time.monotonic()
+
+
+class PrefetchScheduler:
+    def __init__(self, concurrency: int) -> None:
+        self.concurrency = concurrency
+        self.active = 0
+        # 提升优先级时直接再放一份进堆，取出时跳过已经开始的
+        self.queue: list[tuple[int, int, PrefetchTicket]] = []
+        self.counter = itertools.count()
+        self.wait_times: dict[PrefetchPriority, deque[float]] = {priority: deque(maxlen=100) for priority in PrefetchPriority}
+
+    @property
+    def queue_depth(self) -> int:
+        return len({id(ticket) for _, _, ticket in self.queue if not ticket.future.done()})
+
+    async def wait(self, ticket: PrefetchTicket) -> None:
+        if self.active < self.concurrency:
+            self.start(ticket)
+            return
+        heapq.heappush(self.queue, (ticket.priority, next(self.counter), ticket))
+        await ticket.future
+
+    def promote(self, ticket: PrefetchTicket, priority: PrefetchPriority) -> None:
+        if priority < ticket.priority and not ticket.future.done():
+            ticket.priority = priority
+            heapq.heappush(self.queue, (priority, next(self.counter), ticket))
+
+    def start(self, ticket: PrefetchTicket) -> None:
+        self.active += 1
+        wait_time = time.monotonic() - ticket.queued_at
+        self.wait_times[ticket.priority].append(wait_time)
+        PREFETCH_QUEUE_WAIT.observe(wait_time, ticket.priority.name.lower())
+        ticket.future.set_result(None)
+
+    def release(self) -> None:
+        self.active -= 1
+        while self.queue and self.active < self.concurrency:
+            _, _, ticket = heapq.heappop(self.queue)
+            if not ticket.future.done():
+                self.start(ticket)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "active": self.active,
+            "queue_depth": self.queue_depth,
+            **{f"{priority.name.lower()}_wait_avg": sum(times) / len(times) if times else 0 for priority, times in self.wait_times.items()},
+            **{f"{priority.name.lower()}_wait_max": max(times, default=0) for priority, times in self.wait_times.items()},
+        }
+
 
 class PrefetchTask:
-    def __init__(self, prefetcher: "Prefetcher", id: int) -> None:
+    def __init__(self, prefetcher: "Prefetcher", id: int, priority: PrefetchPriority) -> None:
         self.prefetcher = prefetcher
         self.id = id
+        self.ticket = PrefetchTicket(priority)
         self.headers_future: asyncio.Future[dict[str, str] | PrefetchError] = asyncio.Future()
-        self.chunk_events: set[asyncio.Event] = set()
+        # 所有读者共享同一个 Event，每写入一块就换一个新的
+        self.chunk_event = asyncio.Event()
         self.finished = False
+        self.finished_event = asyncio.Event()
+        self.size = 0
+        # 最近写入的数据块，追上进度的读者直接从内存读取
+        self.buffer: deque[bytes] = deque()
+        self.buffer_start = 0
         logger.info(f"开始下载 {self.prefetcher.DIR} {id}")
         asyncio.create_task(self.download())
 
     async def download(self) -> None:
+        io = self.prefetcher.io
+        scheduler = self.prefetcher.scheduler
         try:
-            try_remove(f"{self.prefetcher.DIR}/{self.id}.json")
-            try_remove(f"{self.prefetcher.DIR}/{self.id}")
-            response = await self.prefetcher.request(self.id, headers={"Accept-Encoding": "identity"})
-            os.makedirs(self.prefetcher.DIR, exist_ok=True)
+            with span(f"{self.prefetcher.DIR}.queue", id=self.id):
+                await scheduler.wait(self.ticket)
+            self.prefetcher.untrack(self.id)
+            await io.run(self.prefetcher.store.remove, self.id)
+            await io.remove(f"{self.prefetcher.DIR}/{self.id}")
+            with span(f"{self.prefetcher.DIR}.connect", id=self.id):
+                response = await self.prefetcher.request(self.id, headers={"Accept-Encoding": "identity"})
+            await io.run(os.makedirs, self.prefetcher.DIR, 0o777, True)
             if isinstance(response, PrefetchError):
-                with open(f"{self.prefetcher.DIR}/{self.id}.json") as f:
-                    pydantic_dump(PrefetchCacheItem(error=response), f)
+                await io.run(self.prefetcher.store.save, self.id, PrefetchCacheItem(error=response))
+                self.prefetcher.track(self.id, 0)
                 self.headers_future.set_result(response)
                 return
             async with response:
                 if not response.ok:
                     self.headers_future.set_result(PrefetchError(status=response.status, body=await response.text(errors="replace")))
                     return
-                with open(f"{self.prefetcher.DIR}/{self.id}", "wb") as f:
+                f = await io.run(open, f"{self.prefetcher.DIR}/{self.id}", "wb")
+                try:
                     headers = {}
                     if "Content-Length" in response.headers:
                         headers["Content-Length"] = response.headers["Content-Length"]
                     self.headers_future.set_result(headers)
-                    async for data in response.content.iter_any():
-                        f.write(data)
-                        for event in self.chunk_events:
-                            event.set()
+                    with span(f"{self.prefetcher.DIR}.download", id=self.id) as attrs:
+                        async for data in response.content.iter_any():
+                            await io.run(write_chunk, f, data)
+                            self.push_chunk(data)
+                        attrs["size"] = self.size
+                finally:
+                    await io.run(f.close)
             logger.info(f"下载完成 {self.prefetcher.DIR} {self.id}")
-            with open(f"{self.prefetcher.DIR}/{self.id}.json", "w") as f:
-                pydantic_dump(PrefetchCacheItem(), f)
+            await io.run(self.prefetcher.store.save, self.id, PrefetchCacheItem())
+            self.prefetcher.track(self.id, self.size)
+        except Exception as e:
+            logger.warning(f"下载 {self.prefetcher.DIR} {self.id} 失败: {e!r}")
+            if not self.headers_future.done():
+                self.headers_future.set_result(PrefetchError(status=502, body=str(e)))
         finally:
+            if self.ticket.future.done() and not self.ticket.future.cancelled():
+                scheduler.release()
+            else:
+                self.ticket.future.cancel()
             self.finished = True
+            self.finished_event.set()
             # 不加上这里有时候可能会死锁
-            for event in self.chunk_events:
-                event.set()
+            self.chunk_event.set()
             if self.prefetcher.tasks.get(self.id) == self:
                 del self.prefetcher.tasks[self.id]
             if self.prefetcher.ttl is not None:
                 self.prefetcher.schedule_delete(self.id, self.prefetcher.ttl)
 
+    def push_chunk(self, data: bytes) -> None:
+        PREFETCH_DOWNLOADED.inc(self.prefetcher.DIR, amount=len(data))
+        self.buffer.append(data)
+        self.size += len(data)
+        buffer_size = self.prefetcher.buffer_size
+        while len(self.buffer) > 1 and self.size - self.buffer_start - len(self.buffer[0]) >= buffer_size:
+            self.buffer_start += len(self.buffer.popleft())
+        event, self.chunk_event = self.chunk_event, asyncio.Event()
+        event.set()
+
+    def read_buffer(self, pos: int, stop: int) -> memoryview:
+        offset = self.buffer_start
+        for chunk in self.buffer:
+            if pos < offset + len(chunk):
+                return memoryview(chunk)[pos - offset:stop - offset]
+            offset += len(chunk)
+        return memoryview(b"")
+
     async def stream(self, request: web.Request) -> web.StreamResponse:
         logger.info(f"正在串流 {self.prefetcher.DIR} {self.id}")
-        headers = await self.headers_future
+        with span(f"{self.prefetcher.DIR}.wait_headers", id=self.id):
+            headers = await self.headers_future
         if isinstance(headers, PrefetchError):
             return web.Response(body=headers.body, status=headers.status)
-        response = web.StreamResponse(headers=headers)
+        start, stop, status = 0, None, 200
+        if "Content-Length" in headers:
+            total = int(headers["Content-Length"])
+            headers = {**headers, "Accept-Ranges": "bytes"}
+            if byte_range := resolve_range(request, total):
+                start, stop = byte_range
+                status = 206
+                headers["Content-Length"] = str(stop - start)
+                headers["Content-Range"] = f"bytes {start}-{stop - 1}/{total}"
+        elif parse_range(request) is not None:
+            # 不知道总长度时无法计算范围，等下载完再交给 FileResponse 处理
+            await self.finished_event.wait()
+            if not await self.prefetcher.io.exists(f"{self.prefetcher.DIR}/{self.id}"):
+                return web.HTTPNotFound()
+            return web.FileResponse(f"{self.prefetcher.DIR}/{self.id}")
+        response = web.StreamResponse(status=status, headers=headers)
         await response.prepare(request)
-        chunk_event = asyncio.Event()
-        self.chunk_events.add(chunk_event)
+        io = self.prefetcher.io
+        f = None
         try:
-            with open(f"{self.prefetcher.DIR}/{self.id}", "rb") as f:
-                await response.write(f.read())
-                while not self.finished:
-                    await chunk_event.wait()
-                    chunk_event.clear()
-                    await response.write(f.read())
+            with span(f"{self.prefetcher.DIR}.stream", id=self.id) as attrs:
+                pos = start
+                while stop is None or pos < stop:
+                    available = self.size if stop is None else min(self.size, stop)
+                    if pos < min(self.buffer_start, available):
+                        # 落后于内存缓冲区的读者按固定大小从磁盘追赶
+                        if f is None:
+                            f = await io.run(open, f"{self.prefetcher.DIR}/{self.id}", "rb")
+                        data = await io.run(read_chunk, f, pos, min(READ_CHUNK_SIZE, self.buffer_start - pos, available - pos))
+                    elif pos < available:
+                        data = self.read_buffer(pos, available)
+                    elif self.finished:
+                        break
+                    else:
+                        await self.chunk_event.wait()
+                        continue
+                    if not data:
+                        break
+                    pos += len(data)
+                    await response.write(data)
+                attrs["size"] = pos - start
         finally:
-            self.chunk_events.remove(chunk_event)
+            if f is not None:
+                await io.run(f.close)
         return response
 
 
-class Prefetcher:
+class Prefetcher(Expirable):
     DIR: ClassVar[str]
+    # 其他进程同一个文件在这段时间内只通知 leader 一次使用
+    TOUCH_INTERVAL: ClassVar[float] = 60
 
-    def __init__(self, ttl: float | None) -> None:
+    def __init__(
+        self,
+        client: aiohttp.ClientSession,
+        ngproxy_client: aiohttp.ClientSession,
+        proxy: str | None,
+        ttl: float | None,
+        store: MetadataStore[PrefetchCacheItem],
+        expiry: ExpiryScheduler,
+        io: FileIO,
+        scheduler: PrefetchScheduler,
+        retry: RetryPolicy,
+        ngproxy: CircuitBreaker | None,
+        hedge: bool = False,
+        hedge_delay: float | None = None,
+        max_bytes: int | None = None,
+        buffer_size: int = 1024 * 1024,
+        health: HealthProbe | None = None,
+        leadership: Leadership | None = None,
+    ) -> None:
         self.tasks: dict[int, PrefetchTask] = {}
+        self.client = client
+        self.ngproxy_client = ngproxy_client
+        self.proxy = proxy
+        self.io = io
+        self.scheduler = scheduler
         self.ttl = ttl
-        self.delete_tokens: dict[int, asyncio.TimerHandle] = {}
+        self.retry = retry
+        self.ngproxy = ngproxy
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.latency: dict[Literal["ngproxy", "origin"], deque[float]] = {"ngproxy": deque(maxlen=100), "origin": deque(maxlen=100)}
+        self.hedged = 0
+        # 按最近使用顺序排列的已下载文件及其大小，占用超出 max_bytes 时从最久未使用的开始删除
+        self.max_bytes = max_bytes
+        self.usage: OrderedDict[int, int] = OrderedDict()
+        self.usage_bytes = 0
+        self.evicting = False
+        self.buffer_size = buffer_size
+        self.health = health
+        # 多进程模式下只有 leader 进程下载和删除文件，其他进程通过 spool 把任务交给它
+        self.leadership = leadership
+        self.spool = Spool(PrefetchRequest, f"{self.DIR}_spool") if leadership is not None and leadership.shared else None
+        self.touch_spool = Spool(PrefetchTouch, f"{self.DIR}_touch") if self.spool is not None and max_bytes is not None else None
+        self.touched: LruCache[int, bool] = LruCache(10000, 10000)
+        self.store = store
+        self.expiry = expiry
 
     async def request(self, id: int, **kw: Any) -> aiohttp.ClientResponse | PrefetchError:
         raise NotImplementedError
 
-    def schedule(self, id: int) -> PrefetchTask:
+    def current_hedge_delay(self) -> float:
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        # 没有设置时等待 NGProxy 平时 90% 的请求所需的时间，样本不够时等待 1 秒
+        if len(self.latency["ngproxy"]) < 20:
+            return 1
+        return quantile(self.latency["ngproxy"], 0.9)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "disk_files": len(self.usage),
+            "disk_bytes": self.usage_bytes,
+            "hedged": self.hedged,
+            "hedge_delay": self.current_hedge_delay(),
+            **{f"{source}_p50": quantile(latency, 0.5) for source, latency in self.latency.items()},
+            **{f"{source}_p90": quantile(latency, 0.9) for source, latency in self.latency.items()},
+        }
+
+    async def fetch(self, url: str, ngproxy_url: str, **kw: Any) -> aiohttp.ClientResponse:
+        retry = self.retry.start()
+        ngproxy_available = self.ngproxy is not None
+
+        async def ngproxy() -> aiohttp.ClientResponse | None:
+            nonlocal ngproxy_available
+            assert self.ngproxy is not None
+            start_time = time.monotonic()
+            try:
+                response = await self.ngproxy_client.get(ngproxy_url, **kw)
+            except aiohttp.ClientError as e:
+                self.ngproxy.failure()
+                logger.warning(f"请求 {ngproxy_url} 失败: {e!r}")
+                return None
+            except asyncio.TimeoutError:
+                # 超时的请求至少用了这么久，也记入样本，否则只统计到快的请求
+                self.latency["ngproxy"].append(time.monotonic() - start_time)
+                self.ngproxy.failure()
+                logger.warning(f"请求 {ngproxy_url} 超时，改用原链接")
+                return None
+            except asyncio.CancelledError:
+                self.latency["ngproxy"].append(time.monotonic() - start_time)
+                raise
+            self.ngproxy.record(response.status)
+            logger.log("DEBUG" if response.ok else "WARNING", f"{response.status} {response.method} {response.url}")
+            if response.ok:
+                self.latency["ngproxy"].append(time.monotonic() - start_time)
+                return response
+            response.close()
+            if not self.retry.retryable(response.status):
+                ngproxy_available = False
+            return None
+
+        async def origin() -> aiohttp.ClientResponse | None:
+            start_time = time.monotonic()
+            response = await retry.attempt(lambda: self.client.get(url, proxy=self.proxy, **kw))
+            if response is not None and response.ok:
+                self.latency["origin"].append(time.monotonic() - start_time)
+            return response
+
+        while True:
+            if ngproxy_available and self.ngproxy is not None and self.ngproxy.allow():
+                if not self.hedge:
+                    if (response := await ngproxy()) is not None:
+                        return response
+                else:
+                    # NGProxy 太慢时同时请求原链接，用先成功的那个
+                    ngproxy_task = asyncio.create_task(ngproxy())
+                    done, _ = await asyncio.wait([ngproxy_task], timeout=self.current_hedge_delay())
+                    if not done:
+                        self.hedged += 1
+                        if (response := await self.race(ngproxy_task, asyncio.create_task(origin()))) is not None:
+                            return response
+                        continue
+                    if (response := ngproxy_task.result()) is not None:
+                        return response
+            if (response := await origin()) is not None:
+                return response
+
+    async def race(self, *tasks: asyncio.Task[aiohttp.ClientResponse | None]) -> aiohttp.ClientResponse | None:
+        # 返回第一个成功的响应，都没有成功时返回失败的响应，需要重试时返回 None
+        pending = set(tasks)
+        best: aiohttp.ClientResponse | None = None
+        error: BaseException | None = None
+        try:
+            while pending and (best is None or not best.ok):
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if (exception := task.exception()) is not None:
+                        error = exception
+                        continue
+                    if (response := task.result()) is None:
+                        continue
+                    if best is None or (response.ok and not best.ok):
+                        if best is not None:
+                            best.close()
+                        best = response
+                    else:
+                        response.close()
+            if best is None and error is not None:
+                raise error
+            return best
+        finally:
+            for task in pending:
+                task.cancel()
+                task.add_done_callback(close_response)
+
+    def schedule(self, id: int, priority: PrefetchPriority = PrefetchPriority.ENSURE) -> PrefetchTask:
         try:
-            return self.tasks[id]
+            task = self.tasks[id]
         except KeyError:
-            task = self.tasks[id] = PrefetchTask(self, id)
+            task = self.tasks[id] = PrefetchTask(self, id, priority)
             return task
+        self.scheduler.promote(task.ticket, priority)
+        return task
 
     def schedule_delete(self, id: int, delay: float) -> None:
-        def do_delete() -> None:
-            logger.info(f"已删除 {self.DIR} {id}")
-            try_remove(f"{self.DIR}/{id}.json")
+        self.expiry.schedule(self, id, delay)
+
+    def remove_files(self, ids: list[int]) -> None:
+        self.store.remove_many(ids)
+        for id in ids:
             try_remove(f"{self.DIR}/{id}")
-            self.delete_tokens.pop(id, None)
 
-        if token := self.delete_tokens.pop(id, None):
-            token.cancel()
-        if delay <= 0:
-            do_delete()
-        else:
-            self.delete_tokens[id] = asyncio.get_running_loop().call_later(delay, do_delete)
+    def track(self, id: int, size: int) -> None:
+        self.untrack(id)
+        self.usage[id] = size
+        self.usage_bytes += size
+        if self.max_bytes is not None and self.usage_bytes > self.max_bytes and not self.evicting:
+            self.evicting = True
+            asyncio.create_task(self.evict())
+
+    def untrack(self, id: int) -> None:
+        if (size := self.usage.pop(id, None)) is not None:
+            self.usage_bytes -= size
+
+    def touch(self, id: int) -> None:
+        if id in self.usage:
+            self.usage.move_to_end(id)
+
+    async def hit(self, id: int) -> None:
+        CACHE_REQUESTS.inc(self.DIR, "hit")
+        if self.leading:
+            self.touch(id)
+        elif self.touch_spool is not None and self.touched.get(id) is None:
+            # 最近使用顺序只有 leader 知道，通知它以免删掉其他进程常用的文件
+            self.touched.put(id, True, 1, time.time() + self.TOUCH_INTERVAL)
+            await self.io.run(self.touch_spool.put, str(id), PrefetchTouch())
+
+    async def evict(self) -> None:
+        try:
+            while self.max_bytes is not None and self.usage_bytes > self.max_bytes:
+                ids: list[int] = []
+                excess = self.usage_bytes - self.max_bytes
+                for id, size in self.usage.items():
+                    if excess <= 0:
+                        break
+                    # 正在重新下载的不能删
+                    if id not in self.tasks:
+                        ids.append(id)
+                        excess -= size
+                if not ids:
+                    break
+                for id in ids:
+                    self.untrack(id)
+                await self.io.run(self.remove_files, ids)
+                CACHE_EVICTED.inc(self.DIR, amount=len(ids))
+                logger.info(f"磁盘占用超出限制，已删除 {len(ids)} 个最久未使用的 {self.DIR}")
+        finally:
+            self.evicting = False
 
-    def clean(self) -> None:
-        if self.ttl is None:
+    def scan_files(self) -> list[tuple[int, float, int]]:
+        items = []
+        for id, item_time in self.store.scan():
+            try:
+                size = os.path.getsize(f"{self.DIR}/{id}")
+            except OSError:
+                size = 0
+            items.append((id, item_time, size))
+        return items
+
+    async def expire(self, ids: list[int]) -> None:
+        # 正在重新下载的不能删
+        ids = [id for id in ids if id not in self.tasks]
+        for id in ids:
+            self.untrack(id)
+        await self.io.run(self.remove_files, ids)
+        if ids:
+            CACHE_EXPIRED.inc(self.DIR, amount=len(ids))
+            logger.info(f"已删除 {len(ids)} 个 {self.DIR}")
+
+    async def clean(self) -> None:
+        if self.ttl is None and self.max_bytes is None:
             return
         current_time = time.time()
-        for file in try_scandir(self.DIR):
-            if not file.name.endswith(".json"):
-                continue
-            with open(file.path) as f:
-                cache = PrefetchCacheItem.model_validate(json.load(f))
-                id = int(file.name.removesuffix(".json"))
-                self.schedule_delete(id, self.ttl - (current_time - cache.time))
+        # 重启后按下载时间近似最近使用顺序
+        for id, item_time, size in sorted(await self.io.run(self.scan_files), key=lambda item: item[1]):
+            if self.ttl is not None:
+                self.schedule_delete(id, self.ttl - (current_time - item_time))
+            self.track(id, size)
+
+    def usable(self, cache: PrefetchCacheItem) -> bool:
+        if self.ttl is None or time.time() - cache.time < self.ttl:
+            return True
+        # 重新下载前会先删除旧文件，上游不可用时继续使用过期的文件
+        return cache.error is None and self.health is not None and not self.health.up
+
+    @property
+    def leading(self) -> bool:
+        return self.leadership is None or self.leadership.is_leader
+
+    async def lead(self) -> None:
+        if self.leadership is not None:
+            await self.leadership.wait()
+        await self.clean()
+        if self.spool is None:
+            return
+        while True:
+            for name, item in await self.io.run(self.spool.take):
+                self.schedule(int(name), item.priority)
+            if self.touch_spool is not None:
+                for name, touch in sorted(await self.io.run(self.touch_spool.take), key=lambda item: item[1].time):
+                    self.touch(int(name))
+            await asyncio.sleep(self.spool.interval)
+
+    async def passthrough(self, request: web.Request, id: int) -> web.StreamResponse:
+        headers = {"Accept-Encoding": request.headers.get("Accept-Encoding", "identity")}
+        if "Range" in request.headers:
+            headers["Range"] = request.headers["Range"]
+        response = await self.request(id, headers=headers, auto_decompress=False)
+        if isinstance(response, PrefetchError):
+            return web.Response(status=response.status, body=response.body)
+        async with response:
+            return await stream_response(request, response)
 
     async def stream(self, request: web.Request, id: int, prefetch: bool = True) -> web.StreamResponse:
         if not prefetch:
-            response = await self.request(id, headers={"Accept-Encoding": request.headers.get("Accept-Encoding", "identity")}, auto_decompress=False)
-            if isinstance(response, PrefetchError):
-                return web.Response(status=response.status, body=response.body)
-            async with response:
-                return await stream_response(request, response)
-        try:
-            with open(f"{self.DIR}/{id}.json") as f:
-                cache = PrefetchCacheItem.model_validate(json.load(f))
-            if self.ttl is None or time.time() - cache.time < self.ttl:
-                if cache.error is not None:
-                    return web.Response(body=cache.error, status=404)
-                else:
-                    return web.FileResponse(f"{self.DIR}/{id}")
-        except FileNotFoundError:
-            pass
-        return await self.schedule(id).stream(request)
+            return await self.passthrough(request, id)
+        if (cache := await self.io.run(self.store.load, id)) is not None and self.usable(cache):
+            await self.hit(id)
+            if cache.error is not None:
+                return web.Response(body=cache.error.body, status=404)
+            else:
+                return web.FileResponse(f"{self.DIR}/{id}")
+        if not self.leading:
+            # 只有 leader 进程下载，这次直接转发，同时让 leader 在后台下载
+            assert self.spool is not None
+            CACHE_REQUESTS.inc(self.DIR, "miss")
+            await self.io.run(self.spool.put, str(id), PrefetchRequest(priority=PrefetchPriority.STREAM))
+            return await self.passthrough(request, id)
+        CACHE_REQUESTS.inc(self.DIR, "in_flight" if id in self.tasks else "miss")
+        return await self.schedule(id, PrefetchPriority.STREAM).stream(request)
+
+    async def ensure(self, id: int, priority: PrefetchPriority = PrefetchPriority.ENSURE) -> bool:
+        # 返回是否开始了新的下载
+        # 预测的请求不算作使用，不计入命中率
+        predict = priority == PrefetchPriority.PREDICT
+        if (cache := await self.io.run(self.store.load, id)) is not None and self.usable(cache):
+            if not predict:
+                await self.hit(id)
+            return False
+        if not self.leading:
+            assert self.spool is not None
+            if not predict:
+                CACHE_REQUESTS.inc(self.DIR, "miss")
+            await self.io.run(self.spool.put, str(id), PrefetchRequest(priority=priority))
+            return True
+        started = id not in self.tasks
+        if not predict:
+            CACHE_REQUESTS.inc(self.DIR, "miss" if started else "in_flight")
+        self.schedule(id, priority)
+        return started
 
-    def ensure(self, id: int) -> None:
-        try:
-            with open(f"{self.DIR}/{id}.json") as f:
-                cache = PrefetchCacheItem.model_validate(json.load(f))
-            if self.ttl is None or time.time() - cache.time < self.ttl:
-                return
-        except FileNotFoundError:
-            pass
-        self.schedule(id)
+    def update_metrics(self) -> None:
+        tasks = [task for task in self.tasks.values() if not task.finished]
+        PREFETCH_ACTIVE.set(len(tasks), self.DIR)
+        PREFETCH_IN_FLIGHT.set(sum(task.size for task in tasks), self.DIR)
+        PREFETCH_BUFFERED.set(sum(task.size - task.buffer_start for task in tasks), self.DIR)
+        PREFETCH_DISK.set(self.usage_bytes, self.DIR)
 
 
 class SongPrefetcher(Prefetcher):
@@ -585,27 +2885,31 @@ class SongPrefetcher(Prefetcher):
     def __init__(
         self,
         client: aiohttp.ClientSession,
+        ngproxy_client: aiohttp.ClientSession,
         proxy: str | None,
         info_cache: SongInfoCache,
         ttl: float | None,
-        retry_count: int | None,
-        retry_4xx: bool,
-        ngproxy: bool,
+        store: MetadataStore[PrefetchCacheItem],
+        expiry: ExpiryScheduler,
+        io: FileIO,
+        scheduler: PrefetchScheduler,
+        retry: RetryPolicy,
+        ngproxy: CircuitBreaker | None,
         assets_server: AssetsServer,
         target_dir: str | None,
+        hedge: bool = False,
+        hedge_delay: float | None = None,
+        max_bytes: int | None = None,
+        buffer_size: int = 1024 * 1024,
+        health: HealthProbe | None = None,
+        leadership: Leadership | None = None,
     ) -> None:
-        super().__init__(ttl)
-        self.client = client
-        self.proxy = proxy
+        super().__init__(client, ngproxy_client, proxy, ttl, store, expiry, io, scheduler, retry, ngproxy, hedge, hedge_delay, max_bytes, buffer_size, health, leadership)
         self.info_cache = info_cache
-        self.retry_count = retry_count
-        self.retry_4xx = retry_4xx
-        self.ngproxy = ngproxy
         self.assets_server = assets_server
         self.target_dir = target_dir
 
     async def request(self, id: int, **kw: Any) -> aiohttp.ClientResponse | PrefetchError:
-        retry_left = self.retry_count
         info = await self.info_cache.get(id)
         if isinstance(info, int):
             return PrefetchError(status=404, body=str(info))
@@ -614,31 +2918,12 @@ class SongPrefetcher(Prefetcher):
         if not url or url == "CUSTOMURL":
             url = f"{await self.assets_server()}/music/{id}.ogg"
             ngproxy_url = f"https://endless-services.zhazha120.cn/api/EndlessProxy/GeometryDash/CustomContent/music/{id}.ogg"
-        ngproxy_available = True
-        while True:
-            if self.ngproxy and ngproxy_available:
-                try:
-                    response = await self.client.get(ngproxy_url, **kw)
-                    logger.log("DEBUG" if response.ok else "WARNING", f"{response.status} {response.method} {response.url}")
-                    if response.ok:
-                        return response
-                    await response.__aexit__(None, None, None)
-                    if not self.retry_4xx and (400 <= response.status <= 499):
-                        ngproxy_available = False
-                except aiohttp.ClientError as e:
-                    logger.warning(f"请求 {ngproxy_url} 失败: {e}")
-            response = await self.client.get(url, proxy=self.proxy, **kw)
-            if response.ok or (retry_left is not None and retry_left <= 0) or (400 <= response.status <= 499 and not self.retry_4xx):
-                logger.log("DEBUG" if response.ok else "WARNING", f"{response.status} {response.method} {response.url}")
-                return response
-            await response.__aexit__(None, None, None)
-            logger.warning(f"{response.status} {response.method} {response.url} 剩余 {retry_left} 次重试")
-            retry_left = None if retry_left is None else retry_left - 1
+        return await self.fetch(url, ngproxy_url, **kw)
 
-    def ensure(self, id: int) -> None:
-        if self.target_dir and (os.path.exists(f"{self.target_dir}/{id}.mp3") or os.path.exists(f"{self.target_dir}/{id}.ogg")):
-            return
-        super().ensure(id)
+    async def ensure(self, id: int, priority: PrefetchPriority = PrefetchPriority.ENSURE) -> bool:
+        if self.target_dir and (await self.io.exists(f"{self.target_dir}/{id}.mp3") or await self.io.exists(f"{self.target_dir}/{id}.ogg")):
+            return False
+        return await super().ensure(id, priority)
 
 
 class SfxPrefetcher(Prefetcher):
@@ -647,65 +2932,178 @@ class SfxPrefetcher(Prefetcher):
     def __init__(
         self,
         client: aiohttp.ClientSession,
+        ngproxy_client: aiohttp.ClientSession,
         proxy: str | None,
         ttl: float | None,
-        retry_count: int | None,
-        retry_4xx: bool,
-        ngproxy: bool,
+        store: MetadataStore[PrefetchCacheItem],
+        expiry: ExpiryScheduler,
+        io: FileIO,
+        scheduler: PrefetchScheduler,
+        retry: RetryPolicy,
+        ngproxy: CircuitBreaker | None,
         assets_server: AssetsServer,
         target_dir: str | None,
+        hedge: bool = False,
+        hedge_delay: float | None = None,
+        max_bytes: int | None = None,
+        buffer_size: int = 1024 * 1024,
+        health: HealthProbe | None = None,
+        leadership: Leadership | None = None,
     ) -> None:
-        super().__init__(ttl)
-        self.client = client
-        self.proxy = proxy
-        self.retry_count = retry_count
-        self.retry_4xx = retry_4xx
-        self.ngproxy = ngproxy
+        super().__init__(client, ngproxy_client, proxy, ttl, store, expiry, io, scheduler, retry, ngproxy, hedge, hedge_delay, max_bytes, buffer_size, health, leadership)
         self.assets_server = assets_server
         self.target_dir = target_dir
 
     async def request(self, id: int, **kw: Any) -> aiohttp.ClientResponse:
-        retry_left = self.retry_count
         url = f"{await self.assets_server()}/sfx/s{id}.ogg"
         ngproxy_url = f"https://endless-services.zhazha120.cn/api/EndlessProxy/GeometryDash/CustomContent/sfx/s{id}.ogg"
-        ngproxy_available = True
-        while True:
-            if self.ngproxy and ngproxy_available:
-                try:
-                    response = await self.client.get(ngproxy_url, **kw)
-                    logger.log("DEBUG" if response.ok else "WARNING", f"{response.status} {response.method} {response.url}")
-                    if response.ok:
-                        return response
-                    await response.__aexit__(None, None, None)
-                    if not self.retry_4xx and (400 <= response.status <= 499):
-                        ngproxy_available = False
-                except aiohttp.ClientError as e:
-                    logger.warning(f"请求 {ngproxy_url} 失败: {e}")
-            response = await self.client.get(url, proxy=self.proxy, **kw)
-            if response.ok or (retry_left is not None and retry_left <= 0) or (400 <= response.status <= 499 and not self.retry_4xx):
-                logger.log("DEBUG" if response.ok else "WARNING", f"{response.status} {response.method} {response.url}")
-                return response
-            await response.__aexit__(None, None, None)
-            logger.warning(f"{response.status} {response.method} {response.url} 剩余 {retry_left} 次重试")
-            retry_left = None if retry_left is None else retry_left - 1
+        return await self.fetch(url, ngproxy_url, **kw)
 
-    def ensure(self, id: int) -> None:
-        if self.target_dir and os.path.exists(f"{self.target_dir}/s{id}.ogg"):
-            return
-        super().ensure(id)
+    async def ensure(self, id: int, priority: PrefetchPriority = PrefetchPriority.ENSURE) -> bool:
+        if self.target_dir and await self.io.exists(f"{self.target_dir}/s{id}.ogg"):
+            return False
+        return await super().ensure(id, priority)
+
+
+class ByteBudget:
+    def __init__(self, client_bytes: int, global_bytes: int, window: float) -> None:
+        self.client_bytes = client_bytes
+        self.global_bytes = global_bytes
+        self.window = window
+        self.window_start = time.monotonic()
+        self.clients: dict[str, int] = {}
+        self.total = 0
+
+    def roll(self) -> None:
+        if time.monotonic() - self.window_start >= self.window:
+            self.window_start = time.monotonic()
+            self.clients.clear()
+            self.total = 0
+
+    def allow(self, client: str, size: int) -> bool:
+        self.roll()
+        return self.total + size <= self.global_bytes and self.clients.get(client, 0) + size <= self.client_bytes
+
+    def charge(self, client: str, size: int) -> None:
+        self.clients[client] = self.clients.get(client, 0) + size
+        self.total += size
+
+
+class SongPredictor:
+    def __init__(self, prefetcher: SongPrefetcher, count: int, budget: ByteBudget) -> None:
+        self.prefetcher = prefetcher
+        self.count = count
+        self.budget = budget
+        self.pending: set[asyncio.Task[None]] = set()
+        self.predicted = 0
+        self.over_budget = 0
+
+    def predict(self, client: str, songs: str) -> None:
+        task = asyncio.create_task(self.run(client, songs))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def run(self, client: str, songs: str) -> None:
+        for song in songs.split("~:~")[:self.count] if songs else []:
+            info = load_song_info(song)
+            try:
+                id = int(info[1])
+                # 5 是以 MB 为单位的歌曲大小
+                size = int(float(info.get(5, "0")) * 1024 * 1024)
+            except (KeyError, ValueError):
+                continue
+            if not self.budget.allow(client, size):
+                self.over_budget += 1
+                PREFETCH_PREDICTED.inc("over_budget")
+                continue
+            try:
+                started = await self.prefetcher.ensure(id, PrefetchPriority.PREDICT)
+            except Exception as e:
+                logger.warning(f"预测预载音乐 {id} 失败: {e!r}")
+                continue
+            if started:
+                self.budget.charge(client, size)
+                self.predicted += 1
+                PREFETCH_PREDICTED.inc("scheduled")
+
+    def stats(self) -> dict[str, Any]:
+        return {"predicted": self.predicted, "over_budget": self.over_budget, "window_bytes": self.budget.total, "window_clients": len(self.budget.clients)}
 
 
 CONFIG = web.AppKey("CONFIG", Config)
-HTTP_CLIENT = web.AppKey("HTTP_CLIENT", aiohttp.ClientSession)
+LEADERSHIP = web.AppKey("LEADERSHIP", Leadership)
+FILE_IO = web.AppKey("FILE_IO", FileIO)
+TRACER = web.AppKey("TRACER", Tracer)
+HTTP_POOLS = web.AppKey("HTTP_POOLS", dict[str, ConnectionPool])
 BACKUP_SCHEDULER = web.AppKey("BACKUP_SCHEDULER", BackupScheduler)
+SAVE_HISTORY = web.AppKey("SAVE_HISTORY", SaveHistory)
+BACKUP_SPOOL = web.AppKey("BACKUP_SPOOL", Spool[BackupTask])
 API_MANAGER = web.AppKey("API_MANAGER", ApiManager)
+EXPIRY_SCHEDULER = web.AppKey("EXPIRY_SCHEDULER", ExpiryScheduler)
+RESPONSE_CACHE = web.AppKey("RESPONSE_CACHE", ResponseCache)
+ASSETS_SERVER = web.AppKey("ASSETS_SERVER", AssetsServer)
+CIRCUIT_BREAKERS = web.AppKey("CIRCUIT_BREAKERS", list[CircuitBreaker])
+HEALTH_PROBE = web.AppKey("HEALTH_PROBE", HealthProbe)
+LEVEL_CACHE = web.AppKey("LEVEL_CACHE", LevelCache)
 SONG_INFO_CACHE = web.AppKey("SONG_INFO_CACHE", SongInfoCache)
 SONG_PREFETCHER = web.AppKey("SONG_PREFETCHER", SongPrefetcher)
 SFX_PREFETCHER = web.AppKey("SFX_PREFETCHER", SfxPrefetcher)
+PREFETCH_SCHEDULER = web.AppKey("PREFETCH_SCHEDULER", PrefetchScheduler)
+SONG_PREDICTOR = web.AppKey("SONG_PREDICTOR", SongPredictor)
 routes = web.RouteTableDef()
+middlewares: list[Any] = []
 form_vaildator = TypeAdapter(dict[str, str])
 
 
+@middlewares.append
+@web.middleware
+async def _(request: web.Request, handler: Callable[[web.Request], Awaitable[web.StreamResponse]]) -> web.StreamResponse:
+    route = request.match_info.route.resource
+    route = "unmatched" if route is None else route.canonical
+    start_time = time.monotonic()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        HTTP_LATENCY.observe(time.monotonic() - start_time, route)
+        HTTP_RESPONSES.inc(route, str(status))
+
+
+@middlewares.append
+@web.middleware
+async def _(request: web.Request, handler: Callable[[web.Request], Awaitable[web.StreamResponse]]) -> web.StreamResponse:
+    if TRACER not in request.app:
+        return await handler(request)
+    trace = Trace(request.app[TRACER], request.headers.get("X-Request-ID") or os.urandom(8).hex())
+    token = current_trace.set(trace)
+    try:
+        with span("request", method=request.method, path=request.path) as attrs:
+            response = await handler(request)
+            attrs["status"] = response.status
+    finally:
+        current_trace.reset(token)
+    # 已经开始发送的响应（串流）无法再添加响应头
+    if not response.prepared:
+        response.headers["X-Request-ID"] = trace.id
+        if request.app[CONFIG].trace_server_timing:
+            response.headers["Server-Timing"] = trace.server_timing()
+    return response
+
+
+@middlewares.append
+@web.middleware
+async def _(request: web.Request, handler: Callable[[web.Request], Awaitable[web.StreamResponse]]) -> web.StreamResponse:
+    try:
+        return await handler(request)
+    except CircuitOpenError as e:
+        return web.Response(status=503, body=str(e))
+
+
 @routes.get("/")
 async def _(request: web.Request) -> web.Response:
     config = request.app[CONFIG]
@@ -717,6 +3115,53 @@ async def _(request: web.Request) -> web.Response:
     ))
 
 
+@routes.get("/status")
+async def _(request: web.Request) -> web.Response:
+    io = request.app[FILE_IO]
+    status: dict[str, Any] = {"pid": os.getpid(), "leader": request.app[LEADERSHIP].is_leader, "io_workers": io.workers, "io_pending": io.pending, "io_queue_depth": io.queue_depth}
+    if BACKUP_SCHEDULER in request.app:
+        status["backup"] = request.app[BACKUP_SCHEDULER].stats()
+    for key, name in ((SONG_PREFETCHER, "song_prefetch"), (SFX_PREFETCHER, "sfx_prefetch")):
+        if key in request.app:
+            status[name] = request.app[key].stats()
+    status["prefetch_scheduler"] = request.app[PREFETCH_SCHEDULER].stats()
+    if LEVEL_CACHE in request.app:
+        status["level_cache"] = request.app[LEVEL_CACHE].stats()
+    if SONG_PREDICTOR in request.app:
+        status["song_predictor"] = request.app[SONG_PREDICTOR].stats()
+    status["pools"] = {name: pool.stats() for name, pool in request.app[HTTP_POOLS].items()}
+    status["circuit_breakers"] = {breaker.name: breaker.state for breaker in request.app[CIRCUIT_BREAKERS]}
+    if HEALTH_PROBE in request.app:
+        status["health"] = request.app[HEALTH_PROBE].stats()
+    coalesced = status["coalesced"] = {"api": request.app[RESPONSE_CACHE].flight.coalesced}
+    if LEVEL_CACHE in request.app:
+        coalesced["level"] = request.app[LEVEL_CACHE].flight.coalesced
+    if SONG_INFO_CACHE in request.app:
+        coalesced["song_info"] = request.app[SONG_INFO_CACHE].flight.coalesced
+    if isinstance(assets_server := request.app[ASSETS_SERVER], AssetsServerCache):
+        coalesced["assets_server"] = assets_server.flight.coalesced
+    return web.json_response(status)
+
+
+@routes.get("/metrics")
+async def _(request: web.Request) -> web.Response:
+    app = request.app
+    IO_QUEUE.set(app[FILE_IO].queue_depth)
+    if BACKUP_SCHEDULER in app:
+        stats = app[BACKUP_SCHEDULER].stats()
+        BACKUP_QUEUE.set(stats["queue_depth"], "ready")
+        BACKUP_QUEUE.set(stats["delayed"], "delayed")
+        BACKUP_QUEUE.set(stats["active"], "uploading")
+    for key in (SONG_PREFETCHER, SFX_PREFETCHER):
+        if key in app:
+            app[key].update_metrics()
+    PREFETCH_QUEUE.set(app[PREFETCH_SCHEDULER].queue_depth)
+    for name, pool in app[HTTP_POOLS].items():
+        POOL_USAGE.set(pool.in_flight, name, "in_flight")
+        POOL_USAGE.set(pool.queued, name, "queued")
+    return web.Response(body="".join(metric.render() for metric in METRICS), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
+
+
 @routes.post("/{pad:/*}getAccountURL.php")
 async def _(request: web.Request) -> web.StreamResponse:
     form = form_vaildator.validate_python(await request.post())
@@ -731,47 +3176,70 @@ async def _(request: web.Request) -> web.StreamResponse:
 
 @routes.post("/database/accounts/backupGJAccountNew.php")
 async def _(request: web.Request) -> web.Response:
-    request = request.clone(client_max_size=30 * 1024 * 1024)
-    form = form_vaildator.validate_python(await request.post())
-    account_id = int(form.pop("accountID"))
     config = request.app[CONFIG]
-    if not config.backup_enabled or not config.backup_auth.validate_gjp2(account_id, form["gjp2"]):
+    io = request.app[FILE_IO]
+    if not config.backup_enabled:
         return web.HTTPForbidden(body="-1")
-    ccgamemanager, cclocallevels = form.pop("saveData").split(";")
-    os.makedirs(f"accounts/{account_id}", exist_ok=True)
-    with open(f"accounts/{account_id}/CCGameManager.xml.gz", "wb") as f:
-        f.write(base64.urlsafe_b64decode(ccgamemanager))
-    with open(f"accounts/{account_id}/CCLocalLevels.xml.gz", "wb") as f:
-        f.write(base64.urlsafe_b64decode(cclocallevels))
+    if request.content_type != "application/x-www-form-urlencoded":
+        return web.HTTPBadRequest(body="-1")
+    if request.content_length is not None and request.content_length > config.backup_max_size:
+        return web.HTTPRequestEntityTooLarge(config.backup_max_size, request.content_length, body="-1")
+    # 边读边解码，存档不会整个读入内存
+    parser = SaveUploadParser(io)
+    try:
+        size = 0
+        async for chunk in request.content.iter_any():
+            size += len(chunk)
+            if size > config.backup_max_size:
+                return web.HTTPRequestEntityTooLarge(config.backup_max_size, size, body="-1")
+            await parser.feed(chunk)
+        await parser.finish()
+        form = parser.form
+        account_id = int(form.pop("accountID"))
+        if not await config.backup_auth.validate_gjp2(io, account_id, form["gjp2"]):
+            return web.HTTPForbidden(body="-1")
+        await io.run(parser.commit, account_id)
+        request.app[SAVE_HISTORY].record_later(account_id)
+    except (KeyError, ValueError) as e:
+        logger.warning(f"解析备份数据失败: {e}")
+        return web.HTTPBadRequest(body="-1")
+    finally:
+        await parser.cleanup()
     if config.backup_enabled != "local":
         if not config.backup_server:
-            async with request.app[API_MANAGER].getAccountURL(data={"accountID": account_id, "type": 1, "secret": "Wmfd2893gb7"}) as response:
-                data = await api_read(response)
-                if isinstance(data, web.Response):
-                    logger.warning(f"获取 {account_id} 的备份服务器失败，响应: {data.body!r}")
-                    return data
-                server = AnyUrl(data)
+            try:
+                data = await get_backup_server(request.app[API_MANAGER], account_id)
+            except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError) as e:
+                # 存档已经保存在本地，备份任务照常记录，上传时再查询备份服务器
+                logger.warning(f"获取 {account_id} 的备份服务器失败，稍后重试: {e!r}")
+                data = None
+            if isinstance(data, web.Response):
+                logger.warning(f"获取 {account_id} 的备份服务器失败，响应: {data.body!r}")
+                return data
+            server = None if data is None else AnyUrl(data)
         else:
             server = config.backup_server
-        request.app[BACKUP_SCHEDULER].schedule(account_id, BackupTask(server=server, token=form, retry_left=config.backup_retry_count))
+        task = BackupTask(server=server, token=form, retry_left=config.backup_retry_count)
+        if request.app[LEADERSHIP].is_leader:
+            request.app[BACKUP_SCHEDULER].schedule(account_id, task)
+        else:
+            await io.run(request.app[BACKUP_SPOOL].put, str(account_id), task)
     return web.Response(body="1")
 
 
 @routes.post("/database/accounts/syncGJAccountNew.php")
-async def _(request: web.Request) -> web.Response:
+async def _(request: web.Request) -> web.StreamResponse:
     form = form_vaildator.validate_python(await request.post())
     account_id = int(form["accountID"])
     config = request.app[CONFIG]
-    if not config.backup_enabled or not config.backup_auth.validate_gjp2(account_id, form["gjp2"]):
+    io = request.app[FILE_IO]
+    if not config.backup_enabled or not await config.backup_auth.validate_gjp2(io, account_id, form["gjp2"]):
         return web.HTTPForbidden(body="-1")
     try:
-        with open(f"accounts/{account_id}/CCGameManager.xml.gz", "rb") as f:
-            ccgamemanager = base64.urlsafe_b64encode(f.read()).decode()
-        with open(f"accounts/{account_id}/CCLocalLevels.xml.gz", "rb") as f:
-            cclocallevels = base64.urlsafe_b64encode(f.read()).decode()
+        path = await io.run(get_sync_payload, account_id)
     except FileNotFoundError:
         return web.Response(body="-1")
-    return web.Response(body=f"{ccgamemanager};{cclocallevels};21;30;a;a")
+    return web.FileResponse(path)
 
 
 @routes.post("/{pad:/*}accounts/loginGJAccount.php")
@@ -782,7 +3250,7 @@ async def _(request: web.Request) -> web.Response:
             return data
         account_id, uuid = data.split(",")
         form = form_vaildator.validate_python(await request.post())
-        request.app[CONFIG].backup_auth.write_gjp2(int(account_id), form["gjp2"])
+        await request.app[CONFIG].backup_auth.write_gjp2(request.app[FILE_IO], int(account_id), form["gjp2"])
         return web.Response(body=data)
 
 
@@ -802,19 +3270,23 @@ async def _(request: web.Request) -> web.StreamResponse:
     return web.Response(body=dump_song_info(info))
 
 
-def process_song_list(cache: SongInfoCache, data: str, origin: str) -> str:
+async def process_song_list(cache: SongInfoCache, data: str, origin: str) -> str:
     songs = data.split("~:~") if data else []
-    for i, song in enumerate(songs):
-        info = load_song_info(song)
-        # downloadGJLevel22 返回的 NCS 歌曲信息里的 10 不是 CUSTOMURL 而是 ncs.io 链接
-        if info.get(11, "0") == "1":
-            url = info[10] = "CUSTOMURL"
-        else:
-            url = info.get(10, "")
-        cache.insert(int(info[1]), info)
-        if url and url != "CUSTOMURL":
-            info[10] = f"{origin}/song/{info[1]}"
-        songs[i] = dump_song_info(info)
+    inserts = []
+    with span("process_song_list", songs=len(songs)):
+        for i, song in enumerate(songs):
+            info = load_song_info(song)
+            # downloadGJLevel22 返回的 NCS 歌曲信息里的 10 不是 CUSTOMURL 而是 ncs.io 链接
+            if info.get(11, "0") == "1":
+                url = info[10] = "CUSTOMURL"
+            else:
+                url = info.get(10, "")
+            inserts.append(cache.insert(int(info[1]), info))
+            if url and url != "CUSTOMURL":
+                # 缓存的是原链接，插入完成前不能修改 info
+                info = {**info, 10: f"{origin}/song/{info[1]}"}
+            songs[i] = dump_song_info(info)
+        await asyncio.gather(*inserts)
     return "~:~".join(songs)
 
 
@@ -822,15 +3294,33 @@ def process_song_list(cache: SongInfoCache, data: str, origin: str) -> str:
 async def _(request: web.Request) -> web.StreamResponse:
     config = request.app[CONFIG]
     if not config.song_enabled:
-        return await request.app[API_MANAGER].getGJLevels21.stream(request)
-    async with request.app[API_MANAGER].getGJLevels21(request) as response:
-        data = await api_read(response)
-        if isinstance(data, web.Response):
-            return data
-        data = data.split("#")
+        return await proxy_cached(request, "getGJLevels21")
+    cache = request.app[RESPONSE_CACHE]
+    kw = await forward_kw(request)
+    origin = str(request.url.origin())
+
+    async def fetch() -> CachedResponse:
+        async with request.app[API_MANAGER].getGJLevels21(**kw) as response:
+            body = await response.read()
+        if not response.ok or not body or body.startswith(b"-"):
+            return CachedResponse(status=response.status, body=body)
+        data = body.decode(errors="replace").split("#")
+        if LEVEL_CACHE in request.app:
+            request.app[LEVEL_CACHE].observe(data[0])
         if len(data) >= 3:
-            data[2] = process_song_list(request.app[SONG_INFO_CACHE], data[2], str(request.url.origin()))
-        return web.Response(body="#".join(data))
+            data[2] = await process_song_list(request.app[SONG_INFO_CACHE], data[2], origin)
+        return CachedResponse(status=response.status, body="#".join(data).encode())
+
+    if not cache.cacheable("getGJLevels21"):
+        response = (await fetch()).response()
+    else:
+        response = await cache.handle(request, "getGJLevels21", fetch, origin)
+    # 玩家接下来大概率会打开列表中的关卡，提前下载其中的音乐
+    if SONG_PREDICTOR in request.app and response.status == 200 and isinstance(response.body, bytes):
+        data = response.body.decode(errors="replace").split("#")
+        if len(data) >= 3:
+            request.app[SONG_PREDICTOR].predict(request.remote or "", data[2])
+    return response
 
 
 @routes.post("/{pad:/*}getCustomContentURL.php")
@@ -868,68 +3358,257 @@ async def _(request: web.Request) -> web.StreamResponse:
 
 @routes.post("/{pad:/*}downloadGJLevel22.php")
 async def _(request: web.Request) -> web.StreamResponse:
-    async with request.app[API_MANAGER].downloadGJLevel22(request) as response:
-        data = await api_read(response)
-        if isinstance(data, web.Response):
-            return data
-        data = data.split("#")
-        level = data[0].split(":")
-        level = {int(level[i]): level[i + 1] for i in range(0, len(level), 2)}
-        # 预载单首音乐意义不大
-        # request.app[SONG_PREFETCHER].ensure(int(level[35]))  # song
-        if 52 in level:  # songs
-            for song_id in level[52].split(","):
-                request.app[SONG_PREFETCHER].ensure(int(song_id))
-        if 53 in level:  # sfx
-            for sfx_id in level[53].split(","):
-                request.app[SFX_PREFETCHER].ensure(int(sfx_id))
+    kw = await forward_kw(request)
+    form = await request.post()
+
+    async def fetch() -> CachedResponse:
+        async with request.app[API_MANAGER].downloadGJLevel22(**kw) as response:
+            body = await response.read()
+        if not response.ok or not body or body.startswith(b"-"):
+            return CachedResponse(status=response.status, body=body)
+        data = body.decode(errors="replace").split("#")
         if len(data) >= 5:
-            data[4] = process_song_list(request.app[SONG_INFO_CACHE], data[4], str(request.url.origin()))
-        return web.Response(body="#".join(data))
+            data[4] = await process_song_list(request.app[SONG_INFO_CACHE], data[4], LevelCache.ORIGIN)
+        return CachedResponse(status=200, body="#".join(data).encode())
+
+    if LEVEL_CACHE in request.app and (id := LevelCache.level_id(form)) is not None:
+        level_cache = request.app[LEVEL_CACHE]
+        result = await level_cache.handle(id, level_cache.variant(form), fetch)
+    else:
+        result = await fetch()
+    if result.status != 200 or result.body.startswith(b"-"):
+        return result.response()
+    data = result.body.decode(errors="replace").split("#")
+    level = data[0].split(":")
+    level = {int(level[i]): level[i + 1] for i in range(0, len(level), 2)}
+    # 预载单首音乐意义不大
+    # request.app[SONG_PREFETCHER].ensure(int(level[35]))  # song
+    ensures = []
+    if 52 in level:  # songs
+        ensures += [request.app[SONG_PREFETCHER].ensure(int(song_id)) for song_id in level[52].split(",")]
+    if 53 in level:  # sfx
+        ensures += [request.app[SFX_PREFETCHER].ensure(int(sfx_id)) for sfx_id in level[53].split(",")]
+    with span("prefetch.ensure"):
+        await asyncio.gather(*ensures)
+    return web.Response(body=LevelCache.localize(result.body, str(request.url.origin())))
+
+
+async def forward_kw(request: web.BaseRequest) -> dict[str, Any]:
+    # 后台刷新缓存时请求可能已经结束，所以先把请求体取出来
+    kw: dict[str, Any] = {"data": await request.read()}
+    if "Content-Type" in request.headers:
+        kw["headers"] = {"Content-Type": request.headers["Content-Type"]}
+    return kw
+
+
+async def proxy_cached(request: web.Request, api: str) -> web.StreamResponse:
+    cache = request.app[RESPONSE_CACHE]
+    if not cache.cacheable(api):
+        return await request.app[API_MANAGER][api].stream(request)
+    kw = await forward_kw(request)
+
+    async def fetch() -> CachedResponse:
+        async with request.app[API_MANAGER][api](**kw) as response:
+            return CachedResponse(status=response.status, body=await response.read())
+
+    return await cache.handle(request, api, fetch)
 
 
 @routes.post(r"/{pad:/*}{api:(accounts/)?[A-Za-z0-9]+}.php")
 async def handle_proxy(request: web.Request) -> web.StreamResponse:
-    return await request.app[API_MANAGER][request.match_info["api"]].stream(request)
+    return await proxy_cached(request, request.match_info["api"])
+
+
+async def setup_file_io(app: web.Application) -> AsyncGenerator[None, None]:
+    io = app[FILE_IO] = FileIO(app[CONFIG].io_workers)
+    yield
+    io.shutdown()
+
+
+async def setup_leadership(app: web.Application) -> AsyncGenerator[None, None]:
+    leadership = app[LEADERSHIP]
+    task = asyncio.create_task(leadership.run(app[FILE_IO]))
+    yield
+    task.cancel()
+    leadership.close()
+
+
+async def monitor_loop_lag() -> None:
+    while True:
+        start_time = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(max(0, time.monotonic() - start_time - LOOP_LAG_INTERVAL))
+
+
+async def setup_loop_monitor(app: web.Application) -> AsyncGenerator[None, None]:
+    task = asyncio.create_task(monitor_loop_lag())
+    yield
+    task.cancel()
+
+
+async def setup_tracer(app: web.Application) -> AsyncGenerator[None, None]:
+    config = app[CONFIG]
+    if not config.trace:
+        yield
+        return
+    tracer = app[TRACER] = Tracer(app[FILE_IO], config.trace_file, config.trace_flush_interval)
+    task = asyncio.create_task(tracer.run())
+    yield
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await tracer.close()
+
+
+async def setup_expiry_scheduler(app: web.Application) -> AsyncGenerator[None, None]:
+    config = app[CONFIG]
+    scheduler = app[EXPIRY_SCHEDULER] = ExpiryScheduler(config.expiry_sweep_interval, config.expiry_sweep_batch)
+    task = asyncio.create_task(scheduler.run())
+    yield
+    task.cancel()
 
 
 async def setup_http_client(app: web.Application) -> AsyncGenerator[None, None]:
-    http_client = app[HTTP_CLIENT] = aiohttp.ClientSession()
     config = app[CONFIG]
-    app[API_MANAGER] = api_manager = ApiManager(http_client, str(config.game_server).removesuffix("/"), config.game_retry_count, config.game_retry_4xx, proxy=config.game_proxy_str)
+    # 不同上游分开连接池，大量下载音乐时不会影响 API 请求
+    pools = app[HTTP_POOLS] = {
+        "game": ConnectionPool("game", config.game_pool),
+        "backup": ConnectionPool("backup", config.backup_pool),
+        "ngproxy": ConnectionPool("ngproxy", config.ngproxy_pool),
+        "media": ConnectionPool("media", config.media_pool),
+    }
+    io = app[FILE_IO]
+    db = None
+    db_lock = threading.Lock()
+    if config.metadata_backend == "sqlite":
+        db = SqliteMetadataStore.connect(config.metadata_db)
+
+    async def make_store(model: type[M], name: str) -> MetadataStore[M]:
+        store: MetadataStore[M]
+        if db is not None:
+            store, target = SqliteMetadataStore(model, name, db, db_lock), "SQLite 数据库"
+            olds: list[tuple[str, MetadataStore[M]]] = [("JSON", JsonMetadataStore(model, name)), ("二进制格式", BinaryMetadataStore(model, name))]
+        elif config.metadata_backend == "json":
+            return JsonMetadataStore(model, name)
+        else:
+            store, target = BinaryMetadataStore(model, name), "二进制格式"
+            olds = [("JSON", JsonMetadataStore(model, name))]
+        # 切换存储方式后把原来的元数据转移过来，否则已缓存的内容会丢失，预载文件也不会再被删除
+        for source, old in olds:
+            if count := await io.run(store.migrate, old):
+                logger.info(f"已将 {count} 个 {name} 的元数据从 {source} 转换为 {target}")
+        return store
+
+    breakers = app[CIRCUIT_BREAKERS] = []
+
+    def make_breaker(name: str) -> CircuitBreaker:
+        breaker = CircuitBreaker(name, config.circuit_breaker_threshold, config.circuit_breaker_timeout)
+        breakers.append(breaker)
+        return breaker
+
+    def make_retry(name: Literal["game", "song", "assets"]) -> RetryPolicy:
+        return RetryPolicy(
+            make_breaker(name),
+            getattr(config, f"{name}_retry_count"),
+            getattr(config, f"{name}_retry_4xx"),
+            getattr(config, f"{name}_retry_backoff"),
+            config.retry_backoff_max,
+            config.retry_jitter,
+            getattr(config, f"{name}_retry_deadline"),
+        )
+
+    ngproxy = make_breaker("ngproxy") if config.ngproxy else None
+    game_retry = make_retry("game")
+    app[API_MANAGER] = api_manager = ApiManager(pools["game"].session, str(config.game_server).removesuffix("/"), game_retry, proxy=config.game_proxy_str)
+    health = None
+    if config.health_probe:
+        # 由后台定期检查游戏服务器是否可达，不可达时直接使用本地缓存，请求不用等到超时
+        health = app[HEALTH_PROBE] = HealthProbe("game", pools["game"].session, str(config.game_server), game_retry.breaker, app[EXPIRY_SCHEDULER], config.health_probe_interval, config.health_probe_timeout, config.health_probe_failures, **api_manager.kw)
+        health_task = asyncio.create_task(health.run())
+    app[RESPONSE_CACHE] = ResponseCache(config.response_cache, config.response_cache_bytes, config.response_cache_ignored_fields)
     if config.assets_server is None:
-        assets_server = AssetsServerCache(api_manager.getCustomContentURL, config.assets_server_ttl)
+        assets_server = AssetsServerCache(api_manager.getCustomContentURL, io, config.assets_server_ttl)
     else:
         assets_server = AssetsServerStatic(str(config.assets_server))
+    app[ASSETS_SERVER] = assets_server
+    prefetch_scheduler = app[PREFETCH_SCHEDULER] = PrefetchScheduler(config.prefetch_concurrency)
+    leadership = app[LEADERSHIP]
+    lead_tasks: list[asyncio.Task[None]] = []
+    if config.level_cache:
+        app[LEVEL_CACHE] = level_cache = LevelCache(config.level_cache_ttl, await make_store(LevelCacheItem, "level_cache"), app[EXPIRY_SCHEDULER], io, config.level_cache_compress_level)
+        await level_cache.clean()
     if config.song_enabled:
-        app[SONG_INFO_CACHE] = song_info_cache = SongInfoCache(api_manager.getGJSongInfo, config.song_info_ttl)
-        song_info_cache.clean()
-        app[SONG_PREFETCHER] = song_prefetcher = SongPrefetcher(http_client, config.song_proxy_str, song_info_cache, config.prefetch_ttl, config.song_retry_count, config.song_retry_4xx, config.ngproxy, assets_server, config.prefetch_target_dir)
-        song_prefetcher.clean()
+        app[SONG_INFO_CACHE] = song_info_cache = SongInfoCache(api_manager.getGJSongInfo, config.song_info_ttl, await make_store(SongInfoCacheItem, "song_infos"), app[EXPIRY_SCHEDULER], io, config.song_info_memory_entries, config.song_info_memory_bytes)
+        await song_info_cache.clean()
+        app[SONG_PREFETCHER] = song_prefetcher = SongPrefetcher(pools["media"].session, pools["ngproxy"].session, config.song_proxy_str, song_info_cache, config.prefetch_ttl, await make_store(PrefetchCacheItem, SongPrefetcher.DIR), app[EXPIRY_SCHEDULER], io, prefetch_scheduler, make_retry("song"), ngproxy, assets_server, config.prefetch_target_dir, config.ngproxy_hedge, config.ngproxy_hedge_delay, config.prefetch_max_bytes, config.prefetch_buffer_size, health, leadership)
+        lead_tasks.append(asyncio.create_task(song_prefetcher.lead()))
+        if config.prefetch_predictive:
+            budget = ByteBudget(config.prefetch_predictive_client_bytes, config.prefetch_predictive_global_bytes, config.prefetch_predictive_window)
+            app[SONG_PREDICTOR] = SongPredictor(song_prefetcher, config.prefetch_predictive_count, budget)
     if config.assets_enabled:
-        app[SFX_PREFETCHER] = sfx_prefetcher = SfxPrefetcher(http_client, config.song_proxy_str, config.prefetch_ttl, config.song_retry_count, config.song_retry_4xx, config.ngproxy, assets_server, config.prefetch_target_dir)
-        sfx_prefetcher.clean()
+        app[SFX_PREFETCHER] = sfx_prefetcher = SfxPrefetcher(pools["media"].session, pools["ngproxy"].session, config.assets_proxy_str, config.prefetch_ttl, await make_store(PrefetchCacheItem, SfxPrefetcher.DIR), app[EXPIRY_SCHEDULER], io, prefetch_scheduler, make_retry("assets"), ngproxy, assets_server, config.prefetch_target_dir, config.ngproxy_hedge, config.ngproxy_hedge_delay, config.prefetch_max_bytes, config.prefetch_buffer_size, health, leadership)
+        lead_tasks.append(asyncio.create_task(sfx_prefetcher.lead()))
     yield
-    await http_client.close()
+    for task in lead_tasks:
+        task.cancel()
+    if health is not None:
+        health_task.cancel()
+    for pool in pools.values():
+        await pool.session.close()
+    if db is not None:
+        db.close()
 
 
 async def setup_backup_scheduler(app: web.Application) -> AsyncGenerator[None, None]:
     config = app[CONFIG]
-    scheduler = app[BACKUP_SCHEDULER] = BackupScheduler(app[HTTP_CLIENT], config.backup_retry_interval, config.backup_retry_4xx, proxy=config.backup_proxy_str)
-    try:
-        with open("backup_tasks.json") as f:
-            tasks = TypeAdapter(dict[int, BackupTask]).validate_python(json.load(f))
+    io = app[FILE_IO]
+    journal = BackupJournal(io, config.backup_journal_flush_interval, config.backup_journal_compact_size)
+    scheduler = app[BACKUP_SCHEDULER] = BackupScheduler(
+        app[HTTP_POOLS]["backup"].session,
+        io,
+        config.backup_retry_interval,
+        config.backup_retry_4xx,
+        config.backup_upload_concurrency,
+        config.backup_upload_rate,
+        journal,
+        None if config.backup_server else partial(get_backup_server, app[API_MANAGER]),
+        proxy=config.backup_proxy_str,
+    )
+    history = app[SAVE_HISTORY] = SaveHistory(io, config.backup_history_count)
+    leadership = app[LEADERSHIP]
+    spool = app[BACKUP_SPOOL] = Spool(BackupTask, "backup_spool")
+    journal_task = None
+
+    async def lead() -> None:
+        nonlocal journal_task
+        # 上传任务日志只由 leader 进程读写
+        await leadership.wait()
+        tasks = await io.run(journal.load_sync)
         if tasks:
             logger.info(f"发现 {len(tasks)} 个未上传成功的任务")
+        await journal.compact(tasks)
         for account_id, task in tasks.items():
-            scheduler.schedule(account_id, task)
-    except FileNotFoundError:
-        pass
+            scheduler.schedule(account_id, task, op=None)
+        scheduler.start()
+        journal_task = asyncio.create_task(journal.run(scheduler.tasks))
+        while leadership.shared:
+            for name, task in await io.run(spool.take):
+                scheduler.schedule(int(name), task)
+            await asyncio.sleep(spool.interval)
+
+    lead_task = asyncio.create_task(lead())
     yield
-    with open("backup_tasks.json", "w") as f:
-        pydantic_dump(scheduler.tasks, f)
-    if scheduler.tasks:
-        logger.info(f"已保存 {len(scheduler.tasks)} 个未上传成功的任务")
+    lead_task.cancel()
+    await asyncio.gather(lead_task, return_exceptions=True)
+    if journal_task is not None:
+        # 等日志任务真正退出后再关闭，免得和最后一次写入同时进行
+        journal_task.cancel()
+        await asyncio.gather(journal_task, return_exceptions=True)
+        await scheduler.close()
+        await journal.close(scheduler.tasks)
+        if scheduler.tasks:
+            logger.info(f"已保存 {len(scheduler.tasks)} 个未上传成功的任务")
+    if history.pending:
+        await asyncio.wait(history.pending)
 
 
 def aiohttp_print(text: str) -> None:
@@ -937,22 +3616,171 @@ def aiohttp_print(text: str) -> None:
         logger.opt(depth=1).info(line)
 
 
+def benchmark_metadata(count: int) -> None:
+    samples: list[tuple[str, TimedItem]] = [
+        ("song_prefetch", PrefetchCacheItem()),
+        ("song_infos", SongInfoCacheItem(data={1: "1234567", 2: "Song Name", 3: "12345", 4: "Artist", 5: "9.87", 6: "", 10: "https://audio.ngfiles.com/1234000/1234567_Song-Name.mp3", 7: "", 8: "1"})),
+    ]
+    print("类型\t存储方式\t解码 (µs/次)\t读取 (µs/次)")
+    with tempfile.TemporaryDirectory() as dir:
+        db = SqliteMetadataStore.connect(f"{dir}/metadata.db")
+        for name, item in samples:
+            model = type(item)
+            stores: dict[str, MetadataStore[Any]] = {
+                "json": JsonMetadataStore(model, f"{dir}/json_{name}"),
+                "sqlite": SqliteMetadataStore(model, name, db, threading.Lock()),
+                "binary": BinaryMetadataStore(model, f"{dir}/binary_{name}"),
+            }
+            encoded = {
+                "json": (lambda data: model.model_validate(json.loads(data)), item.model_dump_json()),
+                "sqlite": (model.model_validate_json, item.model_dump_json()),
+                "binary": (lambda data: model.unpack_body(item.time, data[METADATA_HEADER.size:]), METADATA_HEADER.pack(METADATA_MAGIC, item.time) + item.pack_body()),
+            }
+            for backend, store in stores.items():
+                decode, data = encoded[backend]
+                start_time = time.perf_counter()
+                for _ in range(count):
+                    decode(data)
+                decode_time = (time.perf_counter() - start_time) / count
+                for id in range(count):
+                    store.save(id, item)
+                start_time = time.perf_counter()
+                for id in range(count):
+                    store.load(id)
+                load_time = (time.perf_counter() - start_time) / count
+                print(f"{name}\t{backend}\t{decode_time * 1e6:.2f}\t{load_time * 1e6:.2f}")
+        db.close()
+
+
+def make_app(config: Config, workers: int = 1) -> web.Application:
+    app = web.Application(middlewares=middlewares)
+    app[CONFIG] = config
+    app[LEADERSHIP] = Leadership("worker.lock" if workers > 1 else None)
+    app.add_routes(routes)
+    app.cleanup_ctx.append(setup_loop_monitor)
+    app.cleanup_ctx.append(setup_file_io)
+    app.cleanup_ctx.append(setup_leadership)
+    app.cleanup_ctx.append(setup_tracer)
+    app.cleanup_ctx.append(setup_expiry_scheduler)
+    app.cleanup_ctx.append(setup_http_client)
+    if config.backup_enabled:
+        app.cleanup_ctx.append(setup_backup_scheduler)
+    return app
+
+
+def serve_worker(config: Config, workers: int) -> None:
+    # 单独的进程组，Ctrl+C 只发给主进程，由主进程通知各个工作进程退出
+    os.setpgrp()
+    web.run_app(make_app(config, workers), host=str(config.host), port=config.port, reuse_port=True, print=aiohttp_print)
+
+
+WORKER_MIN_UPTIME = 10
+WORKER_MAX_RESTARTS = 5
+WORKER_MAX_RESTART_DELAY = 60
+
+
+def run_workers(config: Config, workers: int) -> None:
+    context = multiprocessing.get_context("fork")
+    processes: dict[int, Any] = {}
+    started: dict[int, float] = {}
+    failures: dict[int, int] = defaultdict(int)
+    restarts: dict[int, float] = {}
+    stopping = False
+
+    def spawn(index: int) -> None:
+        process = processes[index] = context.Process(target=serve_worker, args=(config, workers), name=f"worker-{index}")
+        process.start()
+        started[index] = time.monotonic()
+        logger.info(f"已启动工作进程 {process.pid}")
+
+    def stop(signum: int, frame: Any) -> None:
+        nonlocal stopping
+        stopping = True
+        for process in processes.values():
+            if process.pid is not None and process.is_alive():
+                os.kill(process.pid, signum)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for index in range(workers):
+        spawn(index)
+    while processes or restarts:
+        if stopping:
+            restarts.clear()
+        for index, due in list(restarts.items()):
+            if due <= time.monotonic():
+                del restarts[index]
+                spawn(index)
+        timeout = max(min(restarts.values()) - time.monotonic(), 0) if restarts else None
+        if processes:
+            multiprocessing.connection.wait([process.sentinel for process in processes.values()], timeout)
+        elif timeout is not None:
+            # 分段等待，收到信号时能及时退出
+            time.sleep(min(timeout, 1))
+        for index, process in list(processes.items()):
+            if process.is_alive():
+                continue
+            del processes[index]
+            if stopping:
+                continue
+            # 启动后很快就退出多半是端口被占用、配置错误等问题，重启也没用，逐渐延长重启间隔，多次失败后放弃
+            if time.monotonic() - started[index] < WORKER_MIN_UPTIME:
+                failures[index] += 1
+            else:
+                failures[index] = 0
+            if failures[index] > WORKER_MAX_RESTARTS:
+                logger.error(f"工作进程 {process.pid} 连续 {failures[index]} 次启动后很快退出（{process.exitcode}），不再重启")
+                continue
+            delay = min(2 ** failures[index] - 1, WORKER_MAX_RESTART_DELAY)
+            logger.warning(f"工作进程 {process.pid} 意外退出（{process.exitcode}），{delay} 秒后重启")
+            restarts[index] = time.monotonic() + delay
+    if not stopping:
+        logger.error("所有工作进程都已退出")
+        raise SystemExit(1)
+
+
 def main() -> None:
+    parser = argparse.ArgumentParser(description="Geometry Dash 本地同步 & 反向代理")
+    parser.add_argument("--list-history", type=int, metavar="ACCOUNT_ID", help="列出帐号的存档历史版本")
+    parser.add_argument("--restore", type=int, nargs=2, metavar=("ACCOUNT_ID", "VERSION"), help="将帐号的存档恢复到指定历史版本")
+    parser.add_argument("--benchmark-metadata", type=int, nargs="?", const=10000, metavar="COUNT", help="测试各种元数据存储方式读取单项的耗时")
+    parser.add_argument("--workers", type=int, default=1, metavar="N", help="工作进程数，大于 1 时多个进程通过 SO_REUSEPORT 监听同一端口（仅支持 Linux 等系统）")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers 必须大于 0")
+    if args.workers > 1 and (fcntl is None or not hasattr(socket, "SO_REUSEPORT")):
+        parser.error("当前系统不支持多进程模式")
+    if args.benchmark_metadata is not None:
+        benchmark_metadata(args.benchmark_metadata)
+        return
     try:
         with open("config.json", "r") as f:
             config = Config.model_validate(json.load(f))
     except FileNotFoundError:
         config = Config()
-    app = web.Application()
-    app[CONFIG] = config
-    app.add_routes(routes)
-    app.cleanup_ctx.append(setup_http_client)
-    if config.backup_enabled:
-        app.cleanup_ctx.append(setup_backup_scheduler)
+    if args.list_history is not None or args.restore is not None:
+        io = FileIO(1)
+        try:
+            history = SaveHistory(io, config.backup_history_count)
+            if args.list_history is not None:
+                for version in history.versions(args.list_history):
+                    save = history.load(args.list_history, version)
+                    size = sum(file.size for file in save.files.values())
+                    print(f"{version}\t{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(save.time))}\t{size} 字节")
+            else:
+                account_id, version = args.restore
+                history.restore_sync(account_id, version)
+                logger.success(f"已将 {account_id} 的存档恢复到版本 {version}")
+        finally:
+            io.shutdown()
+        return
     logger.info("Geometry Dash 本地同步 & 反向代理")
     logger.info(f"游戏服务器 {config.game_server}")
     logger.info(f"备份服务器 {config.backup_server_repr}")
-    web.run_app(app, host=str(config.host), port=config.port, print=aiohttp_print)
+    if args.workers > 1:
+        run_workers(config, args.workers)
+    else:
+        web.run_app(make_app(config), host=str(config.host), port=config.port, print=aiohttp_print)
 
 
 if __name__ == "__main__":